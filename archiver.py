@@ -0,0 +1,155 @@
+"""Streaming tar.bz2 archives compressed on all cores
+
+The tar stream is cut into blocks the size of a bzip2 block and every
+block is compressed in its own thread (bz2 releases the GIL), the
+results are written in order as consecutive bzip2 streams. bunzip2,
+tar and Python's bz2/tarfile read such multi-stream files as one. Only
+a few blocks per core are held in memory; file contents are streamed.
+
+Each archive gets a manifest (size, mtime and sha256 of every file).
+Given the manifest of a previous archive, files that haven't changed
+since are left out, which makes the archive incremental.
+"""
+
+import bz2
+import json
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from hashlib import sha256
+from os import cpu_count, lstat, walk
+from os.path import getmtime, isdir, islink, join
+from stat import S_ISREG
+
+# bzip2 blocks hold up to 900k of input at level 9
+BLOCK_SIZE = 900 * 1000
+CHUNK_SIZE = 256 * 1024
+MANIFEST_SUFFIX = '.manifest.json'
+
+
+class ParallelBz2Writer:
+    """File-like object compressing what is written into fileobj"""
+
+    def __init__(self, fileobj, workers=None, block_size=BLOCK_SIZE,
+                 level=9):
+        self.fileobj = fileobj
+        self.workers = workers or cpu_count() or 1
+        self.block_size = block_size
+        self.level = level
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def _submit(self, block):
+        self.pending.append(self.executor.submit(bz2.compress, block,
+                                                 self.level))
+        # Keep memory bounded; the oldest block is usually done by now
+        while len(self.pending) > 2 * self.workers:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.executor.shutdown()
+
+
+class HashingReader:
+    """Reads fileobj, computing sha256 of what has been read"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.digest = sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.digest.update(data)
+        return data
+
+
+def file_sha256(path):
+    digest = sha256()
+    with open(path, 'rb') as fdesc:
+        for chunk in iter(lambda: fdesc.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def walk_names(names):
+    """Yield names and, for directories, everything below them"""
+    for name in names:
+        yield name
+        if isdir(name) and not islink(name):
+            for dirpath, dirnames, filenames in walk(name):
+                dirnames.sort()
+                for entry in dirnames + sorted(filenames):
+                    yield join(dirpath, entry)
+
+
+def unchanged(path, stat, previous):
+    """Is path the same as when manifest entry previous was taken?"""
+    if previous is None or previous['size'] != stat.st_size:
+        return False
+    if previous['mtime'] == stat.st_mtime_ns:
+        return True
+    # Copied or touched; same content?
+    return previous['sha256'] == file_sha256(path)
+
+
+def load_manifest(path):
+    with open(path) as fdesc:
+        return json.load(fdesc)
+
+
+def latest_manifest(pattern):
+    """Path of the newest manifest of archives matching pattern or None"""
+    manifests = glob(pattern + MANIFEST_SUFFIX)
+    return max(manifests, key=getmtime) if manifests else None
+
+
+def archive(packname, names, previous=None, workers=None):
+    """Write names into packname.tar.bz2, return its name
+
+    With previous, the path of an earlier manifest, files unchanged
+    since are skipped (directories are always recorded).
+    """
+    old = load_manifest(previous)['files'] if previous else {}
+    files = {}
+    skipped = 0
+    tar_name = '{0}.tar.bz2'.format(packname)
+    with open(tar_name, 'wb') as out:
+        writer = ParallelBz2Writer(out, workers)
+        with tarfile.open(fileobj=writer, mode='w|') as tar:
+            for path in walk_names(names):
+                stat = lstat(path)
+                if not S_ISREG(stat.st_mode):
+                    tar.addfile(tar.gettarinfo(path))
+                    continue
+                if unchanged(path, stat, old.get(path)):
+                    files[path] = old[path]
+                    skipped += 1
+                    continue
+                info = tar.gettarinfo(path)
+                with open(path, 'rb') as fdesc:
+                    reader = HashingReader(fdesc)
+                    tar.addfile(info, reader)
+                files[path] = {'size': info.size, 'mtime': stat.st_mtime_ns,
+                               'sha256': reader.digest.hexdigest()}
+        writer.close()
+
+    with open(packname + MANIFEST_SUFFIX, 'w') as fdesc:
+        json.dump({'archive': tar_name, 'previous': previous,
+                   'files': files}, fdesc)
+    if previous:
+        print('{0} files unchanged since {1}'.format(skipped, previous))
+    return tar_name
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""Throughput and latency benchmarks of req_send.py
+
+Runs a fixed set of load profiles against a local fake_cluster.py (or
+against a real proxy given by --url) and prints one line per profile
+run. Results are appended to a results file (see bench_results) and
+compared against a baseline stored there before; a regression makes
+the exit status 1.
+"""
+
+import argparse
+import random
+import socket
+import sys
+from os import makedirs
+from os.path import abspath, dirname, expanduser, join
+from subprocess import Popen
+from time import monotonic, sleep
+
+from bench_results import (ResultStore, compare, fingerprint,
+                           machine_differences, report)
+from req_send import perform_requests, report_json
+
+parser = argparse.ArgumentParser(
+    description='Benchmark req_send.py against a local stand-in cluster.')
+
+parser.add_argument('--url', metavar='url', default=None,
+                    help='Benchmark this URL instead of a local fake cluster')
+parser.add_argument('--profile', metavar='name', action='append',
+                    default=None,
+                    help='Run only this profile (may be repeated)')
+parser.add_argument('--nodes', metavar='n', type=int, default=2,
+                    help='Number of fake backends')
+parser.add_argument('--port', metavar='port', type=int, default=16666,
+                    help='Port of the fake proxy')
+parser.add_argument('--backend-port', metavar='port', type=int, default=18180,
+                    help='Port of the first fake backend')
+parser.add_argument('--latency', metavar='ms', type=float, default=0.0,
+                    help='Latency of fake backends')
+parser.add_argument('--fail-rate', metavar='p', type=float, default=0.0,
+                    help='Fraction of 503 answers of fake backends')
+parser.add_argument('--json', metavar='file',
+                    help='Write results as JSON to file ("-" for stdout)')
+parser.add_argument('--repeat', metavar='n', type=int, default=3,
+                    help='Run every profile n times to tell noise from '
+                    'changes')
+parser.add_argument('--results', metavar='file',
+                    default=join(expanduser('~'), '.cache', 'hw',
+                                 'bench-results.jsonl'),
+                    help='Results file runs are appended to')
+parser.add_argument('--baseline', metavar='name', default='default',
+                    help='Compare against the baseline name')
+parser.add_argument('--save-baseline', metavar='name', default=None,
+                    help='Make this run the baseline name')
+parser.add_argument('--threshold', metavar='pct', type=float, default=5.0,
+                    help='Change for the worse that is a regression even '
+                    'without noise')
+parser.add_argument('--tag', metavar='key=value', action='append',
+                    default=[],
+                    help='Add to the environment fingerprint, e.g. '
+                    'httpd=2.4.25')
+
+# (name, req_send options)
+PROFILES = [
+    ('threads-1', {'cli_num': 1, 'req_num': 2000}),
+    ('threads-50', {'cli_num': 50, 'req_num': 100}),
+    ('no-keep-alive-10', {'cli_num': 10, 'req_num': 100,
+                          'keep-alive': False}),
+    ('asyncio-1000', {'engine': 'asyncio', 'cli_num': 1000, 'req_num': 10}),
+    ('pipeline-8', {'engine': 'asyncio', 'cli_num': 50, 'req_num': 200,
+                    'pipeline': 8}),
+    ('rate-2000', {'engine': 'asyncio', 'cli_num': 100, 'req_num': 20,
+                   'rate': 2000}),
+    ('affinity-500', {'engine': 'asyncio', 'cli_num': 500, 'req_num': 10,
+                      'affinity': True}),
+]
+
+
+def wait_for_port(host, port, timeout=10.0):
+    """Wait until something listens on host:port"""
+    deadline = monotonic() + timeout
+    wait = 0.01
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            if monotonic() > deadline:
+                raise
+            sleep(wait)
+            wait = min(wait * 2, 0.5)
+
+
+def start_fake_cluster(args):
+    command = [sys.executable,
+               join(dirname(abspath(__file__)), 'fake_cluster.py'),
+               '--nodes', str(args.nodes),
+               '--port', str(args.port),
+               '--backend-port', str(args.backend_port),
+               '--latency', str(args.latency),
+               '--fail-rate', str(args.fail_rate),
+               '--seed', '0']
+    proc = Popen(command)
+    try:
+        wait_for_port('127.0.0.1', args.port)
+    except OSError:
+        proc.kill()
+        raise
+    return proc
+
+
+def run_profile(url, profile_opts):
+    # Random send phases and Poisson gaps repeat from run to run
+    random.seed(0)
+    opts = {'url': url, **profile_opts}
+    return perform_requests(opts)
+
+
+def print_row(name, stats):
+    latency = stats.latency
+    print('{0:<18} {1:>8} {2:>7} {3:>10.1f} {4:>9.3f} {5:>9.3f} {6:>9.3f}'
+          .format(name, stats.requests, stats.errors + stats.server_errors,
+                  stats.throughput(), latency.percentile(50) / 1000,
+                  latency.percentile(99) / 1000,
+                  latency.percentile(99.9) / 1000))
+
+
+def run_suite(url, profiles, repeat=1):
+    """Run profiles repeat times, return {name: [Stats.to_dict()]}"""
+    results = {}
+    print('{0:<18} {1:>8} {2:>7} {3:>10} {4:>9} {5:>9} {6:>9}'
+          .format('profile', 'requests', 'errors', 'resp/s', 'p50 ms',
+                  'p99 ms', 'p99.9 ms'))
+    for name, profile_opts in profiles:
+        for i in range(repeat):
+            stats = run_profile(url, profile_opts)
+            print_row(name, stats)
+            results.setdefault(name, []).append(stats.to_dict())
+    return results
+
+
+def gate(store, url, results, baseline, threshold, tags=None,
+         save_baseline=None):
+    """Store results, compare them against baseline; True if no regression
+    """
+    environment = fingerprint(tags)
+    run_id = store.add_run(url, results, environment)
+    stored = store.baseline(baseline)
+    passed = True
+    if stored is None:
+        print('No baseline {0} in {1}'.format(baseline, store.path))
+    else:
+        info, baseline_results = stored
+        print('Compared with baseline {0} (run {1}, {2})'.format(
+            baseline, info['run'], info['time']))
+        for difference in machine_differences(info['fingerprint'],
+                                              environment):
+            print('Warning: other machine, ' + difference)
+        comparisons = compare(baseline_results, results, threshold / 100)
+        print(report(comparisons))
+        regressions = [comparison for comparison in comparisons
+                       if comparison.regression]
+        if regressions:
+            print('{0} regression(s)'.format(len(regressions)))
+            passed = False
+    if save_baseline:
+        store.set_baseline(save_baseline, run_id)
+        print('Run {0} is baseline {1} now'.format(run_id, save_baseline))
+    return passed
+
+
+def main():
+    args = parser.parse_args()
+    if args.repeat < 1:
+        parser.error('--repeat has to be at least 1')
+    tags = {}
+    for tag in args.tag:
+        key, sep, value = tag.partition('=')
+        if not sep:
+            parser.error('Invalid tag {0}'.format(tag))
+        tags[key] = value
+
+    profiles = PROFILES
+    if args.profile:
+        known = dict(PROFILES)
+        unknown = [name for name in args.profile if name not in known]
+        if unknown:
+            parser.error('Unknown profile(s): {0}'.format(', '.join(unknown)))
+        profiles = [(name, known[name]) for name in args.profile]
+
+    proc = None
+    url = args.url
+    if url is None:
+        proc = start_fake_cluster(args)
+        url = 'http://127.0.0.1:{0}/clusterbench/requestinfo'.format(args.port)
+
+    try:
+        results = run_suite(url, profiles, args.repeat)
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    if args.json:
+        report_json(results, args.json)
+
+    makedirs(dirname(abspath(args.results)), exist_ok=True)
+    if not gate(ResultStore(args.results), url, results, args.baseline,
+                args.threshold, tags, args.save_baseline):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+"""Benchmark results kept across runs and compared against a baseline
+
+Results go to a JSON lines file that is only ever appended to: a "run"
+record (when, where, environment fingerprint) followed by one "result"
+record per profile repetition. Naming a run as a baseline appends a
+"baseline" record; the latest one of a name counts. A run cut short
+leaves at most a torn last line, which reading skips.
+
+Comparison is per profile and metric, median against median. A change
+for the worse counts as a regression when it's bigger than the
+threshold or, if the results are noisier than that, than NOISE_FACTOR
+times the relative median absolute deviation of either side. One
+repetition gives no idea of noise; three or more should be run.
+"""
+
+import json
+from os import cpu_count, fsync, getpid, uname
+from os.path import abspath, dirname
+from platform import python_version
+from statistics import median
+from subprocess import run, PIPE, DEVNULL
+from time import strftime
+
+NOISE_FACTOR = 3.0
+# Error rates are compared as absolute differences
+ERROR_RATE_THRESHOLD = 0.001
+
+# (name, extract from Stats.to_dict(), higher is better)
+METRICS = [
+    ('throughput', lambda result: result['throughput'], True),
+    ('p50_ms', lambda result: result['latency_us']['total']['p50'] / 1000,
+     False),
+    ('p99_ms', lambda result: result['latency_us']['total']['p99'] / 1000,
+     False),
+    ('error_rate', lambda result: (result['errors'] + result['server_errors'])
+     / result['requests'] if result['requests'] else 0.0, False),
+]
+
+
+def cpu_model():
+    try:
+        with open('/proc/cpuinfo') as fdesc:
+            for line in fdesc:
+                name, _, value = line.partition(':')
+                if name.strip() == 'model name':
+                    return value.strip()
+    except OSError:
+        pass
+    return None
+
+
+def git_commit():
+    proc = run(['git', 'rev-parse', '--short', 'HEAD'], stdout=PIPE,
+               stderr=DEVNULL, universal_newlines=True,
+               cwd=dirname(abspath(__file__)))
+    return proc.stdout.strip() if proc.returncode == 0 else None
+
+
+def fingerprint(tags=None):
+    """What the results depend on besides the code under test
+
+    tags add what the caller knows, e.g. httpd, mod_cluster and tomcat
+    versions.
+    """
+    system = uname()
+    return {'host': system.nodename,
+            'kernel': system.release,
+            'machine': system.machine,
+            'cpu': cpu_model(),
+            'cpus': cpu_count(),
+            'python': python_version(),
+            'commit': git_commit(),
+            **(tags or {})}
+
+
+# Fingerprint keys that make results of two machines incomparable
+MACHINE_KEYS = ('host', 'machine', 'cpu', 'cpus')
+
+
+class ResultStore:
+    """Append-only file of benchmark runs"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def records(self):
+        try:
+            fdesc = open(self.path)
+        except FileNotFoundError:
+            return
+        with fdesc:
+            for line in fdesc:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+    def append(self, records):
+        data = ''.join(json.dumps(record, sort_keys=True) + '\n'
+                       for record in records)
+        # One write, so concurrent runs don't interleave lines
+        with open(self.path, 'a') as fdesc:
+            fdesc.write(data)
+            fdesc.flush()
+            fsync(fdesc.fileno())
+
+    def add_run(self, url, results, environment):
+        """Store {profile: [Stats.to_dict() of every repetition]} of a run
+        in environment (a fingerprint)
+
+        Return the id of the run.
+        """
+        run_id = '{0}-{1}'.format(strftime('%Y%m%d-%H%M%S'), getpid())
+        records = [{'type': 'run', 'run': run_id,
+                    'time': strftime('%Y-%m-%dT%H:%M:%S%z'), 'url': url,
+                    'fingerprint': environment}]
+        for profile, repetitions in results.items():
+            records += [{'type': 'result', 'run': run_id, 'profile': profile,
+                         'repetition': i, 'results': result}
+                        for i, result in enumerate(repetitions)]
+        self.append(records)
+        return run_id
+
+    def set_baseline(self, name, run_id):
+        self.append([{'type': 'baseline', 'name': name, 'run': run_id}])
+
+    def baseline(self, name):
+        """(run record, {profile: [results]}) of baseline name or None"""
+        run_id = None
+        for record in self.records():
+            if record.get('type') == 'baseline' and record['name'] == name:
+                run_id = record['run']
+        if run_id is None:
+            return None
+        info = None
+        results = {}
+        for record in self.records():
+            if record.get('run') != run_id:
+                continue
+            if record['type'] == 'run':
+                info = record
+            elif record['type'] == 'result':
+                results.setdefault(record['profile'], []).append(
+                    record['results'])
+        return info, results
+
+
+def relative_mad(values):
+    """Median absolute deviation relative to the median"""
+    middle = median(values)
+    if not middle:
+        return 0.0
+    return median(abs(value - middle) for value in values) / abs(middle)
+
+
+class Comparison:
+    """One metric of one profile, baseline against current"""
+
+    def __init__(self, profile, metric, baseline, current, higher_better,
+                 threshold):
+        self.profile = profile
+        self.metric = metric
+        self.baseline = median(baseline)
+        self.current = median(current)
+        if metric == 'error_rate':
+            self.change = self.current - self.baseline
+            self.allowed = ERROR_RATE_THRESHOLD
+        else:
+            self.change = (self.current - self.baseline) / self.baseline \
+                if self.baseline else 0.0
+            self.allowed = max(threshold,
+                               NOISE_FACTOR * max(relative_mad(baseline),
+                                                  relative_mad(current)))
+        worse = -self.change if higher_better else self.change
+        self.regression = worse > self.allowed
+
+    def format(self):
+        if self.metric == 'error_rate':
+            change = '{0:+.3%}'.format(self.change)
+            allowed = '{0:.3%}'.format(self.allowed)
+        else:
+            change = '{0:+.1%}'.format(self.change)
+            allowed = '{0:.1%}'.format(self.allowed)
+        return '{0:<18} {1:<11} {2:>10.3f} {3:>10.3f} {4:>8} {5:>8}{6}'\
+            .format(self.profile, self.metric, self.baseline, self.current,
+                    change, allowed,
+                    '  REGRESSION' if self.regression else '')
+
+
+def compare(baseline, current, threshold=0.05):
+    """Comparisons of {profile: [results]} current against baseline
+
+    Profiles missing on either side are left out.
+    """
+    comparisons = []
+    for profile, results in current.items():
+        if profile not in baseline:
+            continue
+        for metric, extract, higher_better in METRICS:
+            comparisons.append(Comparison(
+                profile, metric, [extract(result)
+                                  for result in baseline[profile]],
+                [extract(result) for result in results], higher_better,
+                threshold))
+    return comparisons
+
+
+def machine_differences(baseline_print, current_print):
+    return ['{0}: {1} != {2}'.format(key, baseline_print.get(key),
+                                     current_print.get(key))
+            for key in MACHINE_KEYS
+            if baseline_print.get(key) != current_print.get(key)]
+
+
+def report(comparisons):
+    lines = ['{0:<18} {1:<11} {2:>10} {3:>10} {4:>8} {5:>8}'.format(
+        'profile', 'metric', 'baseline', 'current', 'change', 'allowed')]
+    lines += [comparison.format() for comparison in comparisons]
+    return '\n'.join(lines)
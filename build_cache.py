@@ -0,0 +1,117 @@
+"""Content-addressed cache of installed Project prefixes
+
+An entry is keyed by a hash of the project's archive (see
+Project.identity(); the URL only when no hash is known), its configure
+arguments and the keys of its dependencies, so any change down the
+dependency chain misses. A hit restores the installed prefix with
+copy-on-write copies (reflinks) where the file system supports them.
+Entries are evicted least recently used first once the cache grows over
+its size limit.
+"""
+
+import json
+from hashlib import sha256
+from os import listdir, lstat, makedirs, rename, getpid, utime, walk
+from os.path import exists, isdir, islink, join
+from shutil import rmtree
+from threading import Lock
+from time import time
+
+from tracing import tracer
+
+META = 'meta.json'
+TREE = 'tree'
+
+
+def tree_size(path):
+    size = 0
+    for dirpath, dirnames, filenames in walk(path):
+        for name in filenames:
+            size += lstat(join(dirpath, name)).st_size
+    return size
+
+
+def copy_tree(src, dst):
+    """Copy contents of src into dst, reflinking files where possible"""
+    makedirs(dst, exist_ok=True)
+    return tracer.call(['cp', '-a', '--reflink=auto', join(src, '.'),
+                        dst]) == 0
+
+
+class BuildCache:
+    """Installed prefixes of built projects stored under root"""
+
+    def __init__(self, root, max_size=4 * 1024 ** 3):
+        self.root = root
+        self.max_size = max_size
+        self.lock = Lock()
+        makedirs(root, exist_ok=True)
+
+    def key(self, project, dependency_keys):
+        """Cache key of project given the keys of its dependencies"""
+        data = json.dumps([project.name, project.identity(),
+                           project.configure_params(),
+                           sorted(dependency_keys)])
+        return sha256(data.encode()).hexdigest()
+
+    def entry(self, key):
+        return join(self.root, key)
+
+    def restore(self, key, install_dir):
+        """Restore entry key into install_dir; False on a miss"""
+        entry = self.entry(key)
+        if not exists(join(entry, META)):
+            return False
+        if isdir(install_dir) and not islink(install_dir):
+            rmtree(install_dir)
+        if not copy_tree(join(entry, TREE), install_dir):
+            return False
+        # mtime of the meta file tracks last use
+        utime(join(entry, META), None)
+        return True
+
+    def store(self, key, name, install_dir):
+        """Copy install_dir into the cache as entry key"""
+        entry = self.entry(key)
+        if exists(join(entry, META)):
+            return
+        tmp = join(self.root, '.tmp-{0}-{1}'.format(key, getpid()))
+        if exists(tmp):
+            rmtree(tmp)
+        if not copy_tree(install_dir, join(tmp, TREE)):
+            rmtree(tmp, ignore_errors=True)
+            return
+        with open(join(tmp, META), 'w') as meta:
+            json.dump({'name': name,
+                       'size': tree_size(join(tmp, TREE)),
+                       'created': time()}, meta)
+        try:
+            rename(tmp, entry)
+        except OSError:
+            # Somebody else stored it meanwhile
+            rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def entries(self):
+        """Return [(last use, size, key)] of all entries"""
+        result = []
+        for key in listdir(self.root):
+            meta_path = join(self.root, key, META)
+            if key.startswith('.') or not exists(meta_path):
+                continue
+            with open(meta_path) as meta:
+                size = json.load(meta).get('size', 0)
+            result.append((lstat(meta_path).st_mtime, size, key))
+        return result
+
+    def evict(self):
+        """Drop least recently used entries until under max_size"""
+        with self.lock:
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, key in entries:
+                if total <= self.max_size:
+                    break
+                print('Evicting {0} from build cache'.format(key))
+                rmtree(self.entry(key), ignore_errors=True)
+                total -= size
@@ -0,0 +1,174 @@
+"""In-process rendering of httpd and tomcat configuration
+
+An upstream config file plus a list of edits compiles into a Template
+once: edits find what they change by pattern rather than line number
+and put {placeholders} where per-node values go. Compiled templates are
+cached by path and mtime; rendering a node's variant only joins strings.
+Files are written atomically (temporary file, then rename), so a
+starting server never sees half of one.
+
+An edit that doesn't find what it's looking for raises ConfigError
+instead of leaving the file unchanged.
+"""
+
+import re
+from os import replace, getpid, stat
+from os.path import dirname, join, basename
+from string import Formatter
+
+
+class ConfigError(ValueError):
+    pass
+
+
+class Sub:
+    """Replace the first match of pattern by repl (re.sub syntax)"""
+
+    def __init__(self, pattern, repl):
+        self.pattern = re.compile(pattern, re.MULTILINE)
+        self.repl = repl
+
+    def apply(self, text):
+        text, count = self.pattern.subn(self.repl, text, count=1)
+        if not count:
+            raise ConfigError('{0!r} not found'.format(self.pattern.pattern))
+        return text
+
+
+class Tag:
+    """Set attributes of the first tag matching pattern
+
+    Tags in comments (server.xml has a commented-out Engine with a
+    jvmRoute before the real one) don't count.
+    """
+
+    tags = re.compile(r'<!--.*?-->|<[^!?/][^>]*>', re.DOTALL)
+
+    def __init__(self, pattern, **attrs):
+        self.pattern = re.compile(pattern, re.DOTALL)
+        self.attrs = attrs
+
+    def set_attr(self, tag, name, value):
+        attr = re.compile(r'\b{0}="[^"]*"'.format(name))
+        if attr.search(tag):
+            return attr.sub('{0}="{1}"'.format(name, value), tag, count=1)
+        end = len(tag) - (2 if tag.endswith('/>') else 1)
+        return '{0} {1}="{2}"{3}'.format(tag[:end].rstrip(), name, value,
+                                         tag[end:])
+
+    def apply(self, text):
+        for match in self.tags.finditer(text):
+            if not match.group().startswith('<!--') \
+                    and self.pattern.search(match.group()):
+                tag = match.group()
+                for name, value in self.attrs.items():
+                    tag = self.set_attr(tag, name, value)
+                return text[:match.start()] + tag + text[match.end():]
+        raise ConfigError('No tag {0!r}'.format(self.pattern.pattern))
+
+
+class InsertBefore:
+    """Insert text on its own lines before the line matching pattern"""
+
+    def __init__(self, pattern, text):
+        self.pattern = re.compile(pattern, re.MULTILINE)
+        self.text = text
+
+    def apply(self, text):
+        match = self.pattern.search(text)
+        if match is None:
+            raise ConfigError('{0!r} not found'.format(self.pattern.pattern))
+        start = text.rfind('\n', 0, match.start()) + 1
+        return text[:start] + self.text + text[start:]
+
+
+class Append:
+    """Add text at the end"""
+
+    def __init__(self, text):
+        self.text = text
+
+    def apply(self, text):
+        if not text.endswith('\n'):
+            text += '\n'
+        return text + self.text
+
+
+class Template:
+    """A config file compiled for rendering"""
+
+    def __init__(self, text, edits):
+        # Braces of the original are literal, the edits add placeholders
+        text = text.replace('{', '{{').replace('}', '}}')
+        for edit in edits:
+            text = edit.apply(text)
+        self.parts = [(literal, field) for literal, field, _, _
+                      in Formatter().parse(text)]
+        self.fields = {field for _, field in self.parts if field is not None}
+
+    def render(self, **values):
+        missing = self.fields - set(values)
+        if missing:
+            raise ConfigError('No value for {0}'.format(
+                ', '.join(sorted(missing))))
+        return ''.join(literal + (str(values[field])
+                                  if field is not None else '')
+                       for literal, field in self.parts)
+
+
+# (path, mtime, edits) -> Template
+_templates = {}
+
+
+def load(path, edits):
+    """Template of path with edits, compiled only once per file version"""
+    key = (path, stat(path).st_mtime_ns, id(edits))
+    template = _templates.get(key)
+    if template is None:
+        with open(path) as fdesc:
+            template = Template(fdesc.read(), edits)
+        _templates[key] = template
+    return template
+
+
+def write_atomic(path, text):
+    tmp = join(dirname(path), '.{0}.{1}.tmp'.format(basename(path), getpid()))
+    with open(tmp, 'w') as fdesc:
+        fdesc.write(text)
+    replace(tmp, path)
+
+
+def render_file(template_path, path, edits, **values):
+    """Render template_path with edits and values into path"""
+    write_atomic(path, load(template_path, edits).render(**values))
+
+
+HTTPD_CONF = [
+    Sub(r'^#(LoadModule proxy_module )', r'\1'),
+    Sub(r'^#(LoadModule proxy_ajp_module )', r'\1'),
+    # Common format plus the time taken (%D), see log_analysis
+    InsertBefore(r'^[ \t]*CustomLog\s+"logs/access_log"\s+common\b',
+                 '    LogFormat "%h %l %u %t \\"%r\\" %>s %b %D" '
+                 'common_latency\n'),
+    Sub(r'^([ \t]*CustomLog\s+"logs/access_log"\s+)common\b',
+        r'\1common_latency'),
+    Append('\nInclude conf/extra/mod_cluster.conf\n'),
+]
+
+SERVER_XML = [
+    InsertBefore(r'^[ \t]*<GlobalNamingResources>',
+                 '  <Listener className="org.jboss.modcluster.container.'
+                 'catalina.standalone.ModClusterListener"\n'
+                 '\t    stickySession="true"\n'
+                 '\t    stickySessionForce="false"\n'
+                 '\t    stickySessionRemove="true" />\n'),
+    Tag(r'^<Server\b', port='{shutdown_port}'),
+    Tag(r'^<Connector\b.*protocol="HTTP/1\.1"', port='{http_port}'),
+    Tag(r'^<Connector\b.*protocol="AJP/1\.3"', port='{ajp_port}',
+        address='{ip}'),
+    Tag(r'^<Engine\b', jvmRoute='{route}'),
+]
+
+MOD_CLUSTER_CONF = [
+    Sub(r'^(\s*MemManagerFile\s+)\S+', r'\1{mem_manager_file}'),
+]
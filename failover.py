@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+"""Failover under sustained load
+
+req_send.py clients keep a steady rate of requests going through the
+proxy, each client holding a session, while backends are killed and
+optionally started again. Every request lands in a timeline of
+BUCKET-wide buckets (successes, errors, latency), from which come:
+
+- the error window: failed (no response or 5xx) requests from the kill
+  on, and how long after it the last one failed;
+- the first good response from a surviving node to a session whose node
+  was killed (displaced), and when all displaced sessions had one;
+- re-stick time: when a displaced session got to the node it stayed on
+  until the end (or until the restart).
+
+Without a URL a fake_cluster.py cluster is run in-process (in a thread
+of its own) and its backend is killed right on time.
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+from threading import Thread
+from time import perf_counter, sleep, time
+
+from fake_cluster import Cluster
+from histogram import Histogram
+from req_send import perform_requests
+
+BUCKET = 0.1
+
+parser = argparse.ArgumentParser(
+    description='Measure failover of a cluster under load.')
+
+parser.add_argument('URL', metavar='url', type=str, nargs='?',
+                    help='URL to load, a local fake cluster if not given')
+parser.add_argument('-X', metavar='n', type=int, default=20,
+                    help='Number of clients (sessions)')
+parser.add_argument('--rate', metavar='r', type=float, default=500.0,
+                    help='Requests per second in total')
+parser.add_argument('--duration', metavar='seconds', type=float,
+                    default=10.0, help='How long the load runs')
+parser.add_argument('--engine', choices=['threads', 'asyncio'],
+                    default='asyncio',
+                    help='Run clients as OS threads or as asyncio tasks')
+parser.add_argument('--kill', metavar='route', default='tomcat1',
+                    help='Backend of the fake cluster to kill')
+parser.add_argument('--kill-after', metavar='seconds', type=float,
+                    default=3.0, help='When to kill it')
+parser.add_argument('--restart-after', metavar='seconds', type=float,
+                    default=None, help='When to start it again')
+parser.add_argument('--nodes', metavar='n', type=int, default=2,
+                    help='Number of fake backends')
+parser.add_argument('--port', metavar='port', type=int, default=16666,
+                    help='Port of the fake proxy')
+parser.add_argument('--backend-port', metavar='port', type=int, default=18180,
+                    help='Port of the first fake backend')
+parser.add_argument('--latency', metavar='ms', type=float, default=0.0,
+                    help='Latency of fake backends')
+parser.add_argument('--json', metavar='file',
+                    help='Write results as JSON to file ("-" for stdout, '
+                    'the report then goes to stderr)')
+
+
+def failed(status):
+    return status == 0 or status >= 500
+
+
+class Bucket:
+    def __init__(self):
+        self.ok = 0
+        self.errors = 0
+        self.latency = Histogram()
+
+
+class Failover:
+    """Timeline of a run and what it says about failover
+
+    timelines are per-client lists of (time, status, seconds, route),
+    times are perf_counter() values like start, kill and restart.
+    """
+
+    def __init__(self, timelines, start, kill, killed, restart=None,
+                 bucket=BUCKET):
+        self.start = start
+        self.kill = kill
+        self.killed = set(killed)
+        self.restart = restart
+        self.bucket = bucket
+        self.buckets = {}
+        for timeline in timelines:
+            for end, status, seconds, route in timeline:
+                index = int((end - start) / bucket)
+                entry = self.buckets.get(index)
+                if entry is None:
+                    entry = self.buckets[index] = Bucket()
+                if failed(status):
+                    entry.errors += 1
+                else:
+                    entry.ok += 1
+                entry.latency.record_seconds(seconds)
+
+        # Requests since the kill, up to the restart
+        until = restart if restart is not None else float('inf')
+        self.errors = [end for timeline in timelines
+                       for end, status, seconds, route in timeline
+                       if kill <= end < until and failed(status)]
+        self.restart_errors = [end for timeline in timelines
+                               for end, status, seconds, route in timeline
+                               if end >= until and failed(status)]
+        self.sessions = 0
+        # Seconds from the kill: first good response, re-stick; None if
+        # never
+        self.first_good = []
+        self.restuck = []
+        self.moved = 0
+        for timeline in timelines:
+            self.add_session(timeline, until)
+
+    def add_session(self, timeline, until):
+        home = None
+        before = [route for end, status, seconds, route in timeline
+                  if end < self.kill and not failed(status)]
+        if before:
+            home = before[-1]
+        after = [(end, route) for end, status, seconds, route in timeline
+                 if self.kill <= end < until and not failed(status)]
+        if home is None:
+            return
+        self.sessions += 1
+        if home not in self.killed:
+            if any(route != home for end, route in after):
+                self.moved += 1
+            return
+
+        good = [(end, route) for end, route in after
+                if route not in self.killed]
+        self.first_good.append(good[0][0] - self.kill if good else None)
+        # The last run of responses from one node, if it's a live one
+        restuck = None
+        if after and after[-1][1] not in self.killed:
+            restuck = after[-1][0]
+            for end, route in reversed(after):
+                if route != after[-1][1]:
+                    break
+                restuck = end
+            restuck -= self.kill
+        self.restuck.append(restuck)
+
+    def error_window(self):
+        """Seconds from the kill to the last failed request or None"""
+        return max(self.errors) - self.kill if self.errors else None
+
+    def to_dict(self):
+        def seconds(values):
+            done = [value for value in values if value is not None]
+            return {'sessions': len(values),
+                    'never': len(values) - len(done),
+                    'first': min(done) if done else None,
+                    'last': max(done) if done else None}
+
+        return {'killed': sorted(self.killed),
+                'kill_at': self.kill - self.start,
+                'restart_at': self.restart - self.start
+                if self.restart is not None else None,
+                'failed_after_kill': len(self.errors),
+                'error_window_s': self.error_window(),
+                'failed_after_restart': len(self.restart_errors),
+                'sessions': self.sessions,
+                'moved_undisturbed': self.moved,
+                'first_good_s': seconds(self.first_good),
+                'restick_s': seconds(self.restuck),
+                'bucket_s': self.bucket,
+                'timeline': [{'at': index * self.bucket,
+                              'ok': entry.ok,
+                              'errors': entry.errors,
+                              'latency_us': entry.latency.summary()}
+                             for index, entry
+                             in sorted(self.buckets.items())]}
+
+    def format_row(self, index):
+        entry = self.buckets.get(index, Bucket())
+        latency = entry.latency
+        return '{0:>8.1f} {1:>6} {2:>6} {3:>9.3f} {4:>9.3f} {5:>9.3f}'.format(
+            index * self.bucket, entry.ok, entry.errors,
+            latency.percentile(50) / 1000, latency.percentile(99) / 1000,
+            latency.max / 1000)
+
+    def report(self):
+        def spread(values, what):
+            done = [value for value in values if value is not None]
+            if not done:
+                return 'no displaced session {0}'.format(what)
+            text = 'first +{0:.3f}s, all {1} by +{2:.3f}s'.format(
+                min(done), len(done), max(done))
+            if len(done) < len(values):
+                text += ', {0} never'.format(len(values) - len(done))
+            return text
+
+        lines = ['Killed {0} at {1:.3f}s'.format(
+            ', '.join(sorted(self.killed)), self.kill - self.start)]
+        window = self.error_window()
+        lines.append('Error window: {0} failed requests{1}'.format(
+            len(self.errors), ', the last +{0:.3f}s after the kill'
+            .format(window) if window is not None else ''))
+        lines.append('Good response from a surviving node: ' +
+                     spread(self.first_good, 'got one'))
+        lines.append('Sessions re-stuck: ' +
+                     spread(self.restuck, 're-stuck'))
+        lines.append('Undisturbed sessions moved: {0} of {1}'.format(
+            self.moved, self.sessions - len(self.restuck)))
+        if self.restart is not None:
+            lines.append('Restarted at {0:.3f}s, {1} failed requests since'
+                         .format(self.restart - self.start,
+                                 len(self.restart_errors)))
+
+        # The buckets around the kill and the restart
+        first = int((self.kill - self.start) / self.bucket)
+        last = int((max(self.errors + [self.kill]) - self.start)
+                   / self.bucket)
+        shown = set(range(first - 3, last + 6))
+        if self.restart is not None:
+            first = int((self.restart - self.start) / self.bucket)
+            shown.update(range(first - 3, first + 6))
+        lines.append('{0:>8} {1:>6} {2:>6} {3:>9} {4:>9} {5:>9}'.format(
+            's', 'ok', 'errors', 'p50 ms', 'p99 ms', 'max ms'))
+        previous = None
+        for index in sorted(index for index in shown if index >= 0):
+            if previous is not None and index != previous + 1:
+                lines.append('{0:>8}'.format('...'))
+            lines.append(self.format_row(index))
+            previous = index
+        return '\n'.join(lines)
+
+
+def measure(opts, kill, kill_after, duration, restart=None,
+            restart_after=None):
+    """Run a load of opts for duration seconds, kill after kill_after
+
+    kill() returns the routes it killed, restart(routes) starts them
+    again after restart_after seconds. opts need a rate; clients get
+    session affinity checking and a timeline. Return (Stats, Failover);
+    the Failover's kill_epoch is when the kill was (seconds since epoch).
+    """
+    cli_num = opts.get('cli_num', 1)
+    opts = {**opts, 'affinity': True, 'timeline': True,
+            'req_num': ceil(opts['rate'] * duration / cli_num)}
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        start = perf_counter()
+        load = executor.submit(perform_requests, opts)
+        sleep(max(0.0, start + kill_after - perf_counter()))
+        killed = kill()
+        kill_time = perf_counter()
+        kill_epoch = time()
+        restart_time = None
+        if restart is not None and restart_after is not None:
+            sleep(max(0.0, start + restart_after - perf_counter()))
+            restart_time = perf_counter()
+            restart(killed)
+        stats = load.result()
+    failover = Failover(stats.timelines, start, kill_time, killed,
+                        restart_time)
+    failover.kill_epoch = kill_epoch
+    return stats, failover
+
+
+class LocalCluster:
+    """fake_cluster.py cluster served by an event loop in a thread"""
+
+    def __init__(self, opts):
+        self.cluster = Cluster(opts)
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.cluster.start(),
+                                         self.loop).result()
+
+    def kill(self, routes):
+        for route in routes:
+            self.loop.call_soon_threadsafe(self.cluster.backend(route).kill)
+        return routes
+
+    def restart(self, routes):
+        for route in routes:
+            asyncio.run_coroutine_threadsafe(
+                self.cluster.backend(route).start(), self.loop).result()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def main():
+    args = parser.parse_args()
+    if args.restart_after is not None \
+            and args.restart_after <= args.kill_after:
+        parser.error('--restart-after has to be after --kill-after')
+
+    opts = {'cli_num': args.X,
+            'url': args.URL,
+            'rate': args.rate,
+            'engine': args.engine}
+
+    cluster = None
+    if args.URL is None:
+        cluster = LocalCluster({'nodes': args.nodes,
+                                'port': args.port,
+                                'backend-port': args.backend_port,
+                                'latency': args.latency})
+        cluster.start()
+        opts['url'] = 'http://127.0.0.1:{0}/clusterbench/requestinfo'.format(
+            args.port)
+    elif args.restart_after is not None:
+        parser.error('Only backends of the fake cluster can be restarted')
+
+    def kill():
+        if cluster is None:
+            # Somebody else kills; the routes are known by then
+            input('Kill {0} and press Enter'.format(args.kill))
+            return [args.kill]
+        return cluster.kill([args.kill])
+
+    # With JSON on stdout everything else goes to stderr
+    with redirect_stdout(sys.stderr if args.json == '-' else sys.stdout):
+        try:
+            stats, failover = measure(
+                opts, kill, args.kill_after, args.duration,
+                cluster.restart if cluster is not None else None,
+                args.restart_after)
+        finally:
+            if cluster is not None:
+                cluster.stop()
+
+        stats.report()
+        print(failover.report())
+    if args.json:
+        data = json.dumps({'load': stats.to_dict(),
+                           'failover': failover.to_dict()}, indent=2)
+        if args.json == '-':
+            sys.stdout.write(data + '\n')
+        else:
+            with open(args.json, 'w') as fdesc:
+                fdesc.write(data + '\n')
+
+
+if __name__ == '__main__':
+    main()
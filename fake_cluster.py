@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""Local stand-in for httpd + mod_cluster + clusterbench Tomcats
+
+N asyncio backends answer /clusterbench/requestinfo the way clusterbench
+does (a "JVM route: tomcatN" line) and hand out JSESSIONID=<id>.<route>
+session cookies. A minimal proxy in front of them sticks sessions to the
+route in the cookie, balances new sessions round robin and fails over
+when a backend is down. Latency, failures and backend outages can be
+injected so req_send.py can be benchmarked on one box without a network.
+"""
+
+import asyncio
+import argparse
+from itertools import count
+from random import random, expovariate, seed
+from time import monotonic
+
+parser = argparse.ArgumentParser(
+    description='Run fake clusterbench backends behind a sticky proxy.')
+
+parser.add_argument('--nodes', metavar='n', type=int, default=2,
+                    help='Number of backends')
+parser.add_argument('--host', metavar='address', default='127.0.0.1',
+                    help='Address to listen on')
+parser.add_argument('--port', metavar='port', type=int, default=6666,
+                    help='Proxy port')
+parser.add_argument('--backend-port', metavar='port', type=int, default=8080,
+                    help='Port of the first backend, the others follow')
+parser.add_argument('--latency', metavar='ms', type=float, default=0.0,
+                    help='Time a backend takes to answer')
+parser.add_argument('--jitter', metavar='ms', type=float, default=0.0,
+                    help='Mean of exponentially distributed extra latency')
+parser.add_argument('--proxy-latency', metavar='ms', type=float, default=0.0,
+                    help='Time the proxy adds to every request')
+parser.add_argument('--fail-rate', metavar='p', type=float, default=0.0,
+                    help='Fraction of requests backends answer with 503')
+parser.add_argument('--drop-rate', metavar='p', type=float, default=0.0,
+                    help='Fraction of requests the proxy drops the '
+                    'connection on')
+parser.add_argument('--outage', metavar='route:start[:duration]',
+                    action='append', default=[],
+                    help='Kill backend route start seconds after startup, '
+                    'bring it back after duration seconds if given')
+parser.add_argument('--seed', metavar='n', type=int, default=None,
+                    help='Seed of the random generator')
+
+REQUESTINFO = '/clusterbench/requestinfo'
+
+
+class Request:
+    """Head of a request read off a stream (plus its body if any)"""
+
+    def __init__(self, head, body):
+        self.head = head
+        self.body = body
+        lines = head.decode('latin-1').split('\r\n')
+        parts = lines[0].split(' ')
+        if len(parts) != 3:
+            raise ValueError('Invalid request line {0!r}'.format(lines[0]))
+        self.method, self.path, self.version = parts
+        self.cookies = {}
+        self.close = self.version != 'HTTP/1.1'
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            name = name.strip().lower()
+            value = value.strip()
+            if name == 'cookie':
+                for cookie in value.split(';'):
+                    cname, _, cvalue = cookie.strip().partition('=')
+                    self.cookies[cname] = cvalue
+            elif name == 'connection':
+                self.close = value.lower() == 'close'
+
+    def session_route(self):
+        session = self.cookies.get('JSESSIONID', '')
+        return session.rpartition('.')[2] if '.' in session else None
+
+
+async def read_request(reader):
+    """Return the next Request or None when the client is done"""
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return None
+    length = 0
+    for line in head.split(b'\r\n'):
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'content-length':
+            length = int(value)
+    body = await reader.readexactly(length) if length else b''
+    return Request(head, body)
+
+
+def response(status, reason, body=b'', headers=()):
+    lines = ['HTTP/1.1 {0} {1}'.format(status, reason)]
+    lines.extend(headers)
+    lines.append('Content-Length: {0}'.format(len(body)))
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+
+def delay(latency, jitter):
+    """Seconds to wait given latency and mean jitter in milliseconds"""
+    wait = latency
+    if jitter:
+        wait += expovariate(1 / jitter)
+    return wait / 1000
+
+
+class Backend:
+    """A clusterbench-like Tomcat node"""
+
+    def __init__(self, route, host, port, latency=0.0, jitter=0.0,
+                 fail_rate=0.0):
+        self.route = route
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.sessions = {}
+        self.ids = count(1)
+        self.server = None
+        self.writers = set()
+        self.requests = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host,
+                                                 self.port, backlog=4096)
+
+    def kill(self):
+        """Stop answering and cut all connections, like SIGKILL would"""
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        for writer in self.writers:
+            writer.transport.abort()
+        self.writers.clear()
+        self.sessions.clear()
+
+    async def handle(self, reader, writer):
+        self.writers.add(writer)
+        try:
+            while True:
+                req = await read_request(reader)
+                if req is None:
+                    break
+                if self.latency or self.jitter:
+                    await asyncio.sleep(delay(self.latency, self.jitter))
+                data = self.respond(req)
+                if req.method == 'HEAD':
+                    # Headers only, Content-Length as for GET
+                    data = data[:data.index(b'\r\n\r\n') + 4]
+                writer.write(data)
+                await writer.drain()
+                if req.close:
+                    break
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    def respond(self, req):
+        self.requests += 1
+        if self.fail_rate and random() < self.fail_rate:
+            return response(503, 'Service Unavailable')
+        if req.path.split('?')[0] != REQUESTINFO:
+            return response(404, 'Not Found')
+
+        headers = []
+        session = req.cookies.get('JSESSIONID')
+        if session not in self.sessions:
+            session = '{0:016X}.{1}'.format(next(self.ids), self.route)
+            self.sessions[session] = 0
+            headers.append('Set-Cookie: JSESSIONID={0}; Path=/clusterbench'
+                           .format(session))
+        self.sessions[session] += 1
+        body = ('Session ID: {0}\n'
+                'Request count: {1}\n'
+                'JVM route: {2}\n'
+                'Server port: {3}\n'
+                .format(session, self.sessions[session], self.route,
+                        self.port)).encode()
+        headers.append('Content-Type: text/plain')
+        return response(200, 'OK', body, headers)
+
+
+class Proxy:
+    """Sticky-session balancer in front of backends"""
+
+    # Seconds a backend that refused a connection is left alone
+    RETRY_DOWN = 1.0
+
+    def __init__(self, backends, host, port, latency=0.0, drop_rate=0.0):
+        self.backends = {backend.route: backend for backend in backends}
+        self.routes = [backend.route for backend in backends]
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.drop_rate = drop_rate
+        self.down_until = {}
+        self.next_route = count()
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host,
+                                                 self.port, backlog=4096)
+
+    def alive(self, route):
+        return self.down_until.get(route, 0) <= monotonic()
+
+    def pick(self, route):
+        """Route of the backend to send a request for session route to"""
+        if route in self.backends and self.alive(route):
+            return route
+        for i in range(len(self.routes)):
+            candidate = self.routes[next(self.next_route) % len(self.routes)]
+            if self.alive(candidate):
+                return candidate
+        return None
+
+    async def handle(self, reader, writer):
+        upstreams = {}
+        try:
+            while True:
+                req = await read_request(reader)
+                if req is None:
+                    break
+                if self.drop_rate and random() < self.drop_rate:
+                    writer.transport.abort()
+                    break
+                if self.latency:
+                    await asyncio.sleep(self.latency / 1000)
+                writer.write(await self.forward(req, upstreams))
+                await writer.drain()
+                if req.close:
+                    break
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            for upstream_writer in upstreams.values():
+                upstream_writer[1].close()
+            writer.close()
+
+    async def forward(self, req, upstreams):
+        """Pass req to a backend and return its raw response"""
+        tried = set()
+        route = self.pick(req.session_route())
+        while route is not None and route not in tried:
+            tried.add(route)
+            try:
+                return await self.exchange(req, route, upstreams)
+            except (OSError, asyncio.IncompleteReadError):
+                upstream = upstreams.pop(route, None)
+                if upstream is not None:
+                    upstream[1].close()
+                self.down_until[route] = monotonic() + self.RETRY_DOWN
+            route = self.pick(None)
+        return response(503, 'Service Unavailable')
+
+    async def exchange(self, req, route, upstreams):
+        if route not in upstreams:
+            backend = self.backends[route]
+            upstreams[route] = await asyncio.open_connection(backend.host,
+                                                             backend.port)
+        reader, writer = upstreams[route]
+        writer.write(req.head + req.body)
+        await writer.drain()
+        head = await reader.readuntil(b'\r\n\r\n')
+        if req.method == 'HEAD':
+            return head
+        length = 0
+        for line in head.split(b'\r\n'):
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'content-length':
+                length = int(value)
+        return head + await reader.readexactly(length)
+
+
+class Cluster:
+    """Backends and the proxy in front of them"""
+
+    def __init__(self, opts):
+        self.opts = opts
+        host = opts.get('host', '127.0.0.1')
+        backend_port = opts.get('backend-port', 8080)
+        self.backends = [Backend('tomcat{0}'.format(i + 1), host,
+                                 backend_port + i,
+                                 latency=opts.get('latency', 0.0),
+                                 jitter=opts.get('jitter', 0.0),
+                                 fail_rate=opts.get('fail-rate', 0.0))
+                         for i in range(opts.get('nodes', 2))]
+        self.proxy = Proxy(self.backends, host, opts.get('port', 6666),
+                           latency=opts.get('proxy-latency', 0.0),
+                           drop_rate=opts.get('drop-rate', 0.0))
+
+    async def start(self):
+        for backend in self.backends:
+            await backend.start()
+        await self.proxy.start()
+
+    def backend(self, route):
+        for backend in self.backends:
+            if backend.route == route:
+                return backend
+        raise KeyError('No backend {0}'.format(route))
+
+    async def outage(self, route, start, duration=None):
+        await asyncio.sleep(start)
+        backend = self.backend(route)
+        print('Killing {0}'.format(route))
+        backend.kill()
+        if duration is not None:
+            await asyncio.sleep(duration)
+            print('Starting {0}'.format(route))
+            await backend.start()
+
+    async def serve(self):
+        await self.start()
+        print('Proxy listening on {0}:{1}'.format(self.proxy.host,
+                                                   self.proxy.port))
+        tasks = []
+        for outage in self.opts.get('outages', []):
+            route, start, duration = (outage.split(':') + [None])[:3]
+            tasks.append(asyncio.ensure_future(self.outage(
+                route, float(start),
+                float(duration) if duration is not None else None)))
+        await self.proxy.server.serve_forever()
+
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+    if args.seed is not None:
+        seed(args.seed)
+
+    opts = {'nodes': args.nodes,
+            'host': args.host,
+            'port': args.port,
+            'backend-port': args.backend_port,
+            'latency': args.latency,
+            'jitter': args.jitter,
+            'proxy-latency': args.proxy_latency,
+            'fail-rate': args.fail_rate,
+            'drop-rate': args.drop_rate,
+            'outages': args.outage}
+
+    try:
+        asyncio.run(Cluster(opts).serve())
+    except KeyboardInterrupt:
+        pass
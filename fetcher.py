@@ -0,0 +1,257 @@
+"""Concurrent, resumable, checksum-verified fetching into a local mirror
+
+Archives are downloaded into a mirror directory that later runs use
+without touching the network. Partial downloads are resumed with HTTP
+range requests. Checksums are given as 'algorithm:hexdigest' or fetched
+from a checksum file published next to the archive (.sha256, .sha1,
+.md5); a verified file gets a .sha256 sidecar so it can be checked again
+offline. Git repositories are kept as bare mirrors that local clones are
+made from.
+"""
+
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from os import makedirs, remove, rename
+from os.path import basename, exists, getsize, join
+from threading import Lock
+from time import sleep
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+
+from tracing import tracer
+
+CHUNK_SIZE = 256 * 1024
+
+
+class FetchError(Exception):
+    pass
+
+
+class Artifact:
+    """A file to fetch from url"""
+
+    def __init__(self, url, checksum=None, checksum_url=None, name=None):
+        self.url = url
+        self.checksum = checksum
+        self.checksum_url = checksum_url
+        self.name = name or basename(urlparse(url).path)
+
+    def key(self):
+        return self.url, self.name
+
+
+class GitRepo:
+    """A git repository mirrored from url"""
+
+    def __init__(self, url, name=None):
+        self.url = url
+        self.name = name or basename(urlparse(url).path)
+        if not self.name.endswith('.git'):
+            self.name += '.git'
+
+    def key(self):
+        return self.url
+
+
+def file_digest(path, algorithm):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as fdesc:
+        for chunk in iter(lambda: fdesc.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def parse_checksum(checksum):
+    algorithm, _, hexdigest = checksum.partition(':')
+    return algorithm.lower(), hexdigest.strip().lower()
+
+
+def content_range_start(resp):
+    """First byte of a 206 response's Content-Range or None"""
+    value = resp.headers.get('Content-Range', '')
+    unit, _, byte_range = value.partition(' ')
+    start = byte_range.partition('-')[0]
+    return int(start) if unit == 'bytes' and start.isdigit() else None
+
+
+class Fetcher:
+    """Fetches artifacts into mirror_dir, at most parallel at a time
+
+    submit() starts a fetch in the background (once per item), fetch()
+    waits for it and returns the local path.
+    """
+
+    def __init__(self, mirror_dir, parallel=4, retries=3, offline=False):
+        self.mirror_dir = mirror_dir
+        self.retries = retries
+        self.offline = offline
+        self.executor = ThreadPoolExecutor(max_workers=parallel)
+        self.futures = {}
+        self.lock = Lock()
+        makedirs(join(mirror_dir, 'git'), exist_ok=True)
+
+    def submit(self, item):
+        with self.lock:
+            future = self.futures.get(item.key())
+            if future is None:
+                if isinstance(item, GitRepo):
+                    future = self.executor.submit(self._mirror_git, item)
+                else:
+                    future = self.executor.submit(self._fetch, item)
+                self.futures[item.key()] = future
+            return future
+
+    def fetch(self, item):
+        return self.submit(item).result()
+
+    def fetch_all(self, items):
+        """Fetch items concurrently, return their local paths"""
+        futures = [self.submit(item) for item in items]
+        return [future.result() for future in futures]
+
+    def digest(self, artifact):
+        """sha256 of artifact as fetched into the mirror or None"""
+        sidecar = self.fetch(artifact) + '.sha256'
+        if not exists(sidecar):
+            return None
+        with open(sidecar) as fdesc:
+            return fdesc.read().strip()
+
+    def clone(self, repo, dest):
+        """Clone repo into dest from its local mirror"""
+        mirror = self.fetch(repo)
+        if exists(dest):
+            print('{0} is already cloned'.format(dest))
+            return dest
+        if tracer.call(['git', 'clone', '--quiet', mirror, dest]) != 0:
+            raise FetchError('Cloning {0} failed'.format(repo.url))
+        return dest
+
+    def close(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def _mirror_git(self, repo):
+        path = join(self.mirror_dir, 'git', repo.name)
+        if exists(path):
+            if not self.offline:
+                print('Updating mirror of {0}'.format(repo.url))
+                if tracer.call(['git', '--git-dir', path, 'remote', 'update',
+                                '--prune']) != 0:
+                    print('Updating {0} failed, using the mirror as is'
+                          .format(repo.url))
+            return path
+        if self.offline:
+            raise FetchError('{0} is not mirrored'.format(repo.url))
+        print('Mirroring {0}'.format(repo.url))
+        tmp = path + '.part'
+        if exists(tmp):
+            tracer.call(['rm', '-rf', tmp])
+        if tracer.call(['git', 'clone', '--quiet', '--mirror', repo.url,
+                        tmp]) != 0:
+            raise FetchError('Mirroring {0} failed'.format(repo.url))
+        rename(tmp, path)
+        return path
+
+    def _fetch(self, artifact):
+        path = join(self.mirror_dir, artifact.name)
+        if exists(path):
+            if self._verify_mirrored(artifact, path):
+                return path
+            print('{0} in mirror is damaged, fetching again'
+                  .format(artifact.name))
+            remove(path)
+        if self.offline:
+            raise FetchError('{0} is not mirrored'.format(artifact.url))
+
+        expected = self._expected_checksum(artifact)
+        part = path + '.part'
+        with tracer.span('download', cat='download', url=artifact.url):
+            for attempt in range(self.retries):
+                try:
+                    self._download(artifact.url, part)
+                    break
+                except (URLError, OSError) as excpt:
+                    if attempt == self.retries - 1:
+                        raise FetchError('Fetching {0} failed: {1}'
+                                         .format(artifact.url, excpt))
+                    print('Fetching {0} failed ({1}), resuming'
+                          .format(artifact.url, excpt))
+                    sleep(2 ** attempt)
+
+        if expected is not None:
+            algorithm, hexdigest = expected
+            actual = file_digest(part, algorithm)
+            if actual != hexdigest:
+                remove(part)
+                raise FetchError('{0}: {1} checksum {2} does not match {3}'
+                                 .format(artifact.url, algorithm, actual,
+                                         hexdigest))
+        else:
+            print('No checksum for {0}, not verified'.format(artifact.url))
+        rename(part, path)
+        self._write_sidecar(path)
+        return path
+
+    def _download(self, url, part):
+        """Download url into part, continuing what is there already"""
+        offset = getsize(part) if exists(part) else 0
+        headers = {'Range': 'bytes={0}-'.format(offset)} if offset else {}
+        print('Downloading {0}{1}'.format(
+            url, ' from byte {0}'.format(offset) if offset else ''))
+        try:
+            resp = urlopen(Request(url, headers=headers), timeout=60)
+        except HTTPError as excpt:
+            if excpt.code == 416 and offset:
+                # Nothing left to fetch
+                return
+            raise
+        with resp:
+            resumed = offset and resp.status == 206
+            if resumed and content_range_start(resp) != offset:
+                raise FetchError('{0}: got {1} when asking for bytes {2}-'
+                                 .format(url, resp.headers['Content-Range'],
+                                         offset))
+            # read() returns b'' on early EOF as well, so count
+            length = resp.headers.get('Content-Length')
+            received = 0
+            with open(part, 'ab' if resumed else 'wb') as fdesc:
+                for chunk in iter(lambda: resp.read(CHUNK_SIZE), b''):
+                    fdesc.write(chunk)
+                    received += len(chunk)
+        if length is not None and length.isdigit() \
+                and received < int(length):
+            raise ConnectionError('Transfer cut short after {0} of {1} bytes'
+                                  .format(received, length))
+
+    def _expected_checksum(self, artifact):
+        """Return (algorithm, hexdigest) to verify artifact with or None"""
+        if artifact.checksum:
+            return parse_checksum(artifact.checksum)
+        if not artifact.checksum_url:
+            return None
+        algorithm = artifact.checksum_url.rsplit('.', 1)[-1].lower()
+        try:
+            with urlopen(artifact.checksum_url, timeout=60) as resp:
+                text = resp.read().decode('ascii', 'replace')
+        except (URLError, OSError) as excpt:
+            raise FetchError('Fetching checksum {0} failed: {1}'
+                             .format(artifact.checksum_url, excpt))
+        tokens = text.split()
+        if not tokens:
+            raise FetchError('Empty checksum {0}'.format(artifact.checksum_url))
+        return algorithm, tokens[0].lower()
+
+    def _write_sidecar(self, path):
+        with open(path + '.sha256', 'w') as fdesc:
+            fdesc.write(file_digest(path, 'sha256') + '\n')
+
+    def _verify_mirrored(self, artifact, path):
+        if artifact.checksum:
+            algorithm, hexdigest = parse_checksum(artifact.checksum)
+            return file_digest(path, algorithm) == hexdigest
+        sidecar = path + '.sha256'
+        if not exists(sidecar):
+            return True
+        with open(sidecar) as fdesc:
+            return file_digest(path, 'sha256') == fdesc.read().strip()
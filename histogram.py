@@ -0,0 +1,100 @@
+"""Log-bucketed latency histogram
+
+Values (microseconds) are counted in buckets whose width doubles every
+power of two, each power of two split into SUB_BUCKETS / 2 buckets. The
+relative error of a reported value is thus below 2 / SUB_BUCKETS while
+memory stays fixed no matter how many values are recorded. Histograms
+of the same layout are merged by adding their counts.
+"""
+
+SUB_BITS = 7
+SUB_BUCKETS = 1 << SUB_BITS
+HALF_BUCKETS = SUB_BUCKETS >> 1
+# Values are clamped to ~12.7 days in microseconds
+MAX_SHIFT = 34
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def bucket_index(value):
+    if value < SUB_BUCKETS:
+        return value
+    shift = min(value.bit_length() - SUB_BITS, MAX_SHIFT)
+    top = min(value >> shift, SUB_BUCKETS - 1)
+    return SUB_BUCKETS + (shift - 1) * HALF_BUCKETS + top - HALF_BUCKETS
+
+
+def bucket_upper(index):
+    """Highest value counted in bucket index"""
+    if index < SUB_BUCKETS:
+        return index
+    shift, top = divmod(index - SUB_BUCKETS, HALF_BUCKETS)
+    shift += 1
+    return ((top + HALF_BUCKETS + 1) << shift) - 1
+
+
+class Histogram:
+    """Fixed-memory, mergeable histogram of microsecond values"""
+
+    def __init__(self):
+        self.counts = [0] * (SUB_BUCKETS + MAX_SHIFT * HALF_BUCKETS)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, value, count=1):
+        value = max(int(value), 0)
+        self.counts[bucket_index(value)] += count
+        self.count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def record_seconds(self, seconds):
+        self.record(seconds * 1000000)
+
+    def merge(self, other):
+        counts = self.counts
+        for i, count in enumerate(other.counts):
+            if count:
+                counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def percentile(self, pct):
+        """Smallest recorded value bound that pct percent of values are under"""
+        if not self.count:
+            return 0
+        wanted = max(1, -(-self.count * pct // 100))
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(bucket_upper(i), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def summary(self, percentiles=PERCENTILES):
+        """Dictionary of count, mean, min, max and percentiles (microseconds)"""
+        summary = {'count': self.count,
+                   'mean': self.mean(),
+                   'min': self.min or 0,
+                   'max': self.max}
+        for pct in percentiles:
+            summary['p{0:g}'.format(pct)] = self.percentile(pct)
+        return summary
+
+    def format(self, percentiles=PERCENTILES):
+        """One line with percentiles in milliseconds"""
+        parts = ['p{0:g}={1:.3f}'.format(pct, self.percentile(pct) / 1000)
+                 for pct in percentiles]
+        parts.append('max={0:.3f}'.format(self.max / 1000))
+        return ' '.join(parts) + ' ms'
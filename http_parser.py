@@ -0,0 +1,224 @@
+"""Incremental HTTP/1.1 response parser
+
+The parser owns a reusable receive buffer. Callers receive straight into
+writable() (socket.recv_into, asyncio.BufferedProtocol.get_buffer) and
+report the byte count to received(). Heads are parsed once; bodies
+delimited by Content-Length, chunked encoding or connection close are
+consumed in place and handed to on_body as memoryview slices, or just
+skipped when nobody listens. Bytes following a complete response stay in
+the buffer for the next one, so pipelined responses are kept apart.
+"""
+
+from time import perf_counter
+
+HEAD, BODY, CHUNK_SIZE, CHUNK_DATA, CHUNK_END, TRAILERS, BODY_EOF, DONE = \
+    range(8)
+
+BUFFER_SIZE = 16 * 1024
+MAX_HEAD_SIZE = 64 * 1024
+
+
+class ParseError(ValueError):
+    pass
+
+
+def session_cookie(value):
+    """Return name=value of a Set-Cookie header unless it is persistent"""
+    if value.lower().find('expires=') != -1:
+        return None
+    return value.split(';', 1)[0].strip()
+
+
+class ResponseParser:
+    """Parses responses arriving over one connection, one after another"""
+
+    def __init__(self, size=BUFFER_SIZE, on_body=None):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        self.on_body = on_body
+        # Responses to HEAD have no body whatever their headers say
+        self.head_request = False
+        self.reset()
+
+    def reset(self):
+        """Forget the previous response, keep bytes received after it"""
+        self.state = HEAD
+        self.remaining = 0
+        self.head = None
+        self.status = None
+        self.headers = []
+        self.sc = None
+        self.keep_alive = False
+        self.first_byte = perf_counter() if self.start < self.end else None
+
+    def clear(self):
+        """Drop everything buffered, e.g. when switching connections"""
+        self.start = self.end = 0
+        self.reset()
+
+    @property
+    def done(self):
+        return self.state == DONE
+
+    def next_response(self):
+        """Start on the following response; True if it is already complete"""
+        self.reset()
+        return self.feed()
+
+    def writable(self):
+        """Free part of the buffer to receive into"""
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buf):
+            if self.start:
+                pending = self.end - self.start
+                self.buf[:pending] = bytes(self.view[self.start:self.end])
+                self.start, self.end = 0, pending
+            else:
+                # Head (or chunk size line) doesn't fit
+                if len(self.buf) >= MAX_HEAD_SIZE:
+                    raise ParseError('Response head too large')
+                self.view.release()
+                self.buf.extend(bytes(len(self.buf)))
+                self.view = memoryview(self.buf)
+        return self.view[self.end:]
+
+    def received(self, nbytes):
+        """Account nbytes written into writable(); True once complete"""
+        if self.first_byte is None:
+            self.first_byte = perf_counter()
+        self.end += nbytes
+        return self.feed()
+
+    def eof(self):
+        """The connection was closed; True if that completed the response"""
+        if self.state == BODY_EOF:
+            self.state = DONE
+            return True
+        return self.state == DONE
+
+    def _body(self, state_after):
+        count = min(self.remaining, self.end - self.start)
+        if count and self.on_body is not None:
+            self.on_body(self.view[self.start:self.start + count])
+        self.start += count
+        self.remaining -= count
+        if not self.remaining:
+            self.state = state_after
+        return count
+
+    def _line(self):
+        """Index of the next CRLF or -1"""
+        return self.buf.find(b'\r\n', self.start, self.end)
+
+    def feed(self):
+        while True:
+            state = self.state
+            if state == DONE:
+                return True
+            if state == HEAD:
+                idx = self.buf.find(b'\r\n\r\n', self.start, self.end)
+                if idx == -1:
+                    return False
+                head = bytes(self.view[self.start:idx]).decode('latin-1')
+                self.start = idx + 4
+                self._parse_head(head)
+            elif state == BODY:
+                if not self._body(DONE):
+                    return False
+            elif state == CHUNK_DATA:
+                if not self._body(CHUNK_END):
+                    return False
+            elif state == CHUNK_SIZE:
+                idx = self._line()
+                if idx == -1:
+                    return False
+                size = bytes(self.view[self.start:idx]).split(b';', 1)[0]
+                try:
+                    self.remaining = int(size, 16)
+                except ValueError:
+                    raise ParseError('Invalid chunk size {0!r}'.format(size))
+                self.start = idx + 2
+                self.state = CHUNK_DATA if self.remaining else TRAILERS
+            elif state == CHUNK_END:
+                if self.end - self.start < 2:
+                    return False
+                self.start += 2
+                self.state = CHUNK_SIZE
+            elif state == TRAILERS:
+                idx = self._line()
+                if idx == -1:
+                    return False
+                if idx == self.start:
+                    self.state = DONE
+                self.start = idx + 2
+            elif state == BODY_EOF:
+                self.remaining = self.end - self.start
+                if not self._body(BODY_EOF):
+                    return False
+
+    def _parse_head(self, head):
+        lines = head.split('\r\n')
+        status_line = lines[0].split(' ', 2)
+        if len(status_line) < 2 or not status_line[0].startswith('HTTP/'):
+            raise ParseError('Invalid status line {0!r}'.format(lines[0]))
+        self.head = head
+        try:
+            self.status = int(status_line[1])
+        except ValueError:
+            raise ParseError('Invalid status line {0!r}'.format(lines[0]))
+        keep_alive = status_line[0] == 'HTTP/1.1'
+        length = None
+        chunked = False
+        headers = []
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if not sep:
+                continue
+            name = name.strip().lower()
+            value = value.strip()
+            headers.append((name, value))
+            if name == 'set-cookie':
+                if self.sc is None:
+                    self.sc = session_cookie(value)
+            elif name == 'content-length':
+                try:
+                    length = int(value)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    raise ParseError('Invalid Content-Length {0!r}'.format(
+                        value))
+            elif name == 'transfer-encoding':
+                chunked = 'chunked' in value.lower()
+            elif name == 'connection':
+                if value.lower() == 'close':
+                    keep_alive = False
+                elif value.lower() == 'keep-alive':
+                    keep_alive = True
+        self.headers = headers
+
+        if 100 <= self.status < 200:
+            # Interim response, the real one follows
+            self.reset()
+            return
+        if self.status in (204, 304) or self.head_request:
+            self.state = DONE
+        elif chunked:
+            self.state = CHUNK_SIZE
+        elif length is not None:
+            self.remaining = length
+            self.state = BODY if length else DONE
+        else:
+            keep_alive = False
+            self.state = BODY_EOF
+        self.keep_alive = keep_alive
+
+    def header(self, name):
+        """Value of the first header called name (lower case) or None"""
+        for header_name, value in self.headers:
+            if header_name == name:
+                return value
+        return None
@@ -2,19 +2,73 @@
 """Test for apache-tomcat running mod_cluseter and apache as a proxy"""
 
 import sys
+import argparse
+import json
 import http.cookiejar
-from os import chdir, getcwd, makedirs, kill, utime, environ
-from os.path import basename, splitext, join, isfile, pardir, exists, dirname
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+from threading import Lock
+from os import chdir, getcwd, makedirs, utime, environ, cpu_count
+from os.path import (basename, splitext, join, isfile, pardir, exists,
+                     expanduser)
 from glob import glob
-from subprocess import call, check_output, DEVNULL
+from subprocess import check_output, DEVNULL, STDOUT
 from tempfile import mkdtemp, NamedTemporaryFile
-from signal import SIGKILL
-from urllib.error import HTTPError
-from urllib.request import (urlopen, build_opener, install_opener,
-                            HTTPCookieProcessor, Request)
-from time import sleep, strftime
+from urllib.request import build_opener, HTTPCookieProcessor
+from time import strftime, monotonic, time
 from shutil import rmtree
-from tarfile import open as tar_open
+
+from archiver import archive, latest_manifest
+import configs
+from bench import PROFILES, gate, run_suite
+from bench_results import ResultStore
+from build_cache import BuildCache
+from failover import measure
+from fetcher import Artifact, Fetcher, GitRepo
+from log_analysis import analyze
+from packages import PackageResolver
+from startup import (Orchestrator, Service, TcpProbe, HttpProbe,
+                     print_report)
+from topology import Topology
+from tracing import tracer
+
+parser = argparse.ArgumentParser(
+    description='Build httpd with mod_cluster and test it with a cluster of '
+    'tomcats (--nodes).')
+
+parser.add_argument('--update', action='store_true',
+                    help='Update the whole system (dnf update) first')
+parser.add_argument('--nodes', metavar='n', type=int, default=2,
+                    help='Number of tomcat nodes')
+parser.add_argument('--failover-load', action='store_true',
+                    help='Kill tomcats while clients keep loading the proxy '
+                    'and report how failover went')
+parser.add_argument('--restart-after', metavar='seconds', type=float,
+                    default=None,
+                    help='With --failover-load, start the killed tomcats '
+                    'again seconds after the load started')
+parser.add_argument('--bench', metavar='baseline', default=None,
+                    help='Benchmark the cluster and fail on a regression '
+                    'against baseline (which this run becomes if there is '
+                    'none yet)')
+parser.add_argument('--incremental', action='store_true',
+                    help='Leave files unchanged since the newest '
+                    '/tmp/artefacts-* archive out of the artefacts')
+
+TOMCAT = Artifact(
+    'https://archive.apache.org/dist/tomcat/tomcat-7/v7.0.73/bin/apache-tomcat-7.0.73.tar.gz',  # noqa
+    checksum_url='https://archive.apache.org/dist/tomcat/tomcat-7/v7.0.73/bin/apache-tomcat-7.0.73.tar.gz.md5')  # noqa
+MOD_CLUSTER_CONF = Artifact(
+    'https://gist.githubusercontent.com/Karm/85cf36a52a8c203accce/raw/a41ecc90fea1f2b3bb880e79fa67fb6c7f61cf68/mod_cluster.conf')  # noqa
+MOD_CLUSTER_REPO = GitRepo('https://github.com/modcluster/mod_cluster.git')
+JBOSS_LOGGING_REPO = GitRepo(
+    'https://github.com/jboss-logging/jboss-logging.git')
+CLUSTERBENCH_REPO = GitRepo('https://github.com/Karm/clusterbench.git')
+MOD_CLUSTER_MODULES = ['mod_proxy_cluster', 'mod_manager',
+                       'mod_cluster_slotmem', 'advertise']
+# Seconds of load before tomcats are killed, in total (--failover-load)
+FAILOVER_KILL = 5.0
+FAILOVER_DURATION = 15.0
 
 
 def touch(fname):
@@ -53,42 +107,25 @@ def get_ip4_address():
     return output
 
 
-def pkg_is_installed(name):
-    ret = call(['dnf', 'list', 'installed', name],
-               stdout=DEVNULL, stderr=DEVNULL)
-    if ret == 0:
-        return True
-    return False
-
-
-def pkg_update():
-    ret = call(['dnf', 'update', '-y'])
-    if ret == 0:
-        return True
-    return False
-
-
-def pkg_install(pkg):
-    ret = call(['dnf', 'install', '-y', pkg])
-    if ret == 0:
-        return True
-    return False
+@tracer.span('pkg_update')
+def pkg_update(resolver):
+    return resolver.update()
 
 
-def cmd(command, params=None, sout=DEVNULL, env=None):
+def cmd(command, params=None, sout=DEVNULL, env=None, cwd=None):
     if params is None:
         params = []
     print('{0} {1}'.format(command, ' '.join(params)))
-    ret = call([command] + params, stdout=sout, env=env)
+    ret = tracer.call([command] + params, stdout=sout, env=env, cwd=cwd)
     if ret != 0:
         print('Returned [{0}]'.format(ret))
     return ret
 
 
-def cmd_checked(command, params=None, sout=DEVNULL, env=None):
+def cmd_checked(command, params=None, sout=DEVNULL, env=None, cwd=None):
     if params is None:
         params = []
-    if cmd(command, params, sout, env) != 0:
+    if cmd(command, params, sout, env, cwd) != 0:
         print('It failed! Bye!')
         sys.exit(0)
 
@@ -97,13 +134,32 @@ class Project:
     """A class encapsulating getting and building project"""
 
     pre_inst_dir = '/tmp'
+    # Downloads go through this Fetcher (and its mirror) when set
+    fetcher = None
 
-    def __init__(self, name, url, dependencies):
+    def __init__(self, name, url, dependencies, checksum=None,
+                 checksum_url=None):
         self.name = name
         self.url = url
         self.dependencies = dependencies
+        self.checksum = checksum
+        self.checksum_url = checksum_url
         self.ready = False
 
+    def artifact(self):
+        return Artifact(self.url, checksum=self.checksum,
+                        checksum_url=self.checksum_url)
+
+    def identity(self):
+        """Hash of the source archive, its URL if there's none"""
+        if self.checksum:
+            return self.checksum
+        if Project.fetcher is not None:
+            digest = Project.fetcher.digest(self.artifact())
+            if digest:
+                return 'sha256:' + digest
+        return self.url
+
     def get_arch_name(self):
         return basename(self.url)
 
@@ -114,156 +170,349 @@ class Project:
     def get_install_dir(self):
         return join(Project.pre_inst_dir, self.name)
 
-    def configure(self):
+    def configure_params(self):
         params = ['--prefix={0}'.format(self.get_install_dir())]
         for dependency in self.dependencies:
             params.append('--with-{0}={1}'.format(dependency.name,
                                                   dependency.get_install_dir()))
-        return cmd('./configure', params)
+        return params
+
+    def configure(self, cwd=None):
+        return cmd('./configure', self.configure_params(), cwd=cwd)
 
-    def download(self):
-        print("Downloading {0} from {1}".format(self.name, self.url))
-        return cmd('wget', ['--quiet', self.url])
+    def download(self, cwd=None):
+        if Project.fetcher is None:
+            print("Downloading {0} from {1}".format(self.name, self.url))
+            return cmd('wget', ['--quiet', self.url], cwd=cwd)
+        path = Project.fetcher.fetch(self.artifact())
+        return cmd('cp', ['--reflink=auto', path, self.get_arch_name()],
+                   cwd=cwd)
 
-    def unpack(self):
+    def unpack(self, cwd=None):
         print("Unpacking {0}".format(self.get_arch_name()))
-        return cmd('tar', ['xjf', self.get_arch_name()])
+        return cmd('tar', ['xjf', self.get_arch_name()], cwd=cwd)
+
+
+class DependencyError(Exception):
+    """Projects depend on something that can't be built before them"""
+
+
+class CpuBudget:
+    """CPUs shared by `make -j' of projects building side by side
+
+    Each project whose dependencies are installed counts towards the
+    split, so a project still configuring leaves room for itself.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.free = total
+        self.ready = 0
+        self.lock = Lock()
+
+    def enter(self):
+        with self.lock:
+            self.ready += 1
+
+    def take(self):
+        """Return number of jobs for a build that starts now"""
+        with self.lock:
+            share = max(1, self.total // self.ready)
+            jobs = max(1, min(share, self.free))
+            self.free -= jobs
+            return jobs
+
+    def give(self, jobs):
+        with self.lock:
+            self.ready -= 1
+            self.free += jobs
 
 
 class ProjectBuilder:
-    """Resolves project dependencies and builds projects"""
+    """Resolves project dependencies and builds projects
+
+    Projects are fetched (downloaded and unpacked) all at once; each is
+    configured and built as soon as its dependencies are installed, so
+    independent projects build side by side sharing a CPU budget. Every
+    step runs in the project's own directory; the process cwd is left
+    alone.
 
-    def __init__(self, projects):
+    With a BuildCache, projects found in it are restored instead of
+    being fetched and built, and fresh builds are stored into it.
+    """
+
+    def __init__(self, projects, jobs=None, cache=None):
         self.projects = projects
+        self.jobs = jobs or cpu_count() or 1
+        self.cache = cache
+
+    def build_order(self):
+        """Return projects sorted so that dependencies come first
+
+        Raise DependencyError on a dependency outside of projects or on a
+        dependency cycle.
+        """
+        order = []
+        state = {}
+
+        def visit(project, path):
+            if state.get(project) == 'done':
+                return
+            if state.get(project) == 'visiting':
+                cycle = path[path.index(project):] + [project]
+                raise DependencyError('Dependency cycle: {0}'.format(
+                    ' -> '.join(proj.name for proj in cycle)))
+            state[project] = 'visiting'
+            for dependency in project.dependencies:
+                if dependency not in self.projects:
+                    raise DependencyError(
+                        '{0} depends on {1} which is not going to be built'
+                        .format(project.name, dependency.name))
+                visit(dependency, path + [project])
+            state[project] = 'done'
+            order.append(project)
 
-    def _get_next(self):
         for project in self.projects:
-            if not project.ready\
-               and all(dependency.ready for dependency in project.dependencies):
-                return project
-        return None
-
-    def build_all(self):
-        def build_proj(proj):
-            if not isfile(proj.get_arch_name()):
-                proj.download()
-            proj.unpack()
-            chdir(proj.get_unpack_dir())
-            proj.configure()
-            cmd_checked('make')
-            cmd_checked('make', ['install'])
-
-        proj = self._get_next()
-        while proj:
-            build_proj(proj)
-            proj.ready = True
-            proj = self._get_next()
-
-        if not all(proj.ready for proj in self.projects):
-            print("Failed to resolve projects")
-
-
-def install_pkgs(pkgs_to_check):
-    print("Check and install required packages")
-    for pkg in pkgs_to_check:
+            visit(project, [])
+        return order
+
+    def cache_keys(self, order):
+        # Keys hash the archives; get them all at once
+        if Project.fetcher is not None:
+            for proj in order:
+                Project.fetcher.submit(proj.artifact())
+        keys = {}
+        for proj in order:
+            keys[proj] = self.cache.key(
+                proj, [keys[dependency] for dependency in proj.dependencies])
+        return keys
+
+    def _restore(self, proj, key):
+        if not self.cache.restore(key, proj.get_install_dir()):
+            return False
+        print('Restored {0} from build cache'.format(proj.name))
+        proj.ready = True
+        return True
 
-        if not pkg_is_installed(pkg):
-            print('{0} is not installed.'.format(pkg))
-            ret = pkg_install(pkg)
-            print('Result {0}.'.format(ret))
+    def _fetch(self, proj, work_dir):
+        if not isfile(join(work_dir, proj.get_arch_name())):
+            proj.download(cwd=work_dir)
+        proj.unpack(cwd=work_dir)
+
+    def _build(self, proj, work_dir, fetched, dependencies, budget):
+        fetched.result()
+        for dependency in dependencies:
+            dependency.result()
+
+        src_dir = join(work_dir, proj.get_unpack_dir())
+        budget.enter()
+        jobs = 0
+        try:
+            proj.configure(cwd=src_dir)
+            jobs = budget.take()
+            cmd_checked('make', ['-j{0}'.format(jobs)], cwd=src_dir)
+        finally:
+            budget.give(jobs)
+        cmd_checked('make', ['install'], cwd=src_dir)
+        proj.ready = True
+
+    def _store_built(self, proj, key, built):
+        built.result()
+        print('Storing {0} into build cache'.format(proj.name))
+        self.cache.store(key, proj.name, proj.get_install_dir())
+
+    def build_all(self, work_dir=None):
+        if work_dir is None:
+            work_dir = getcwd()
+        order = self.build_order()
+        budget = CpuBudget(self.jobs)
+        keys = {}
+        if self.cache is not None:
+            keys = self.cache_keys(order)
+            # Restore hits up front; a failed restore builds after all
+            order_missed = [proj for proj in order
+                            if not self._restore(proj, keys[proj])]
         else:
-            print('{0} is installed.'.format(pkg))
+            order_missed = order
+
+        # A build (and its storing) waits in its own thread
+        executor = ThreadPoolExecutor(max_workers=max(1, 3 * len(order)))
+        try:
+            fetched = {proj: executor.submit(self._fetch, proj, work_dir)
+                       for proj in order_missed}
+            built = {}
+            for proj in order_missed:
+                built[proj] = executor.submit(
+                    self._build, proj, work_dir, fetched[proj],
+                    [built[dependency] for dependency in proj.dependencies
+                     if dependency in built],
+                    budget)
+            stored = []
+            if self.cache is not None:
+                stored = [executor.submit(self._store_built, proj, keys[proj],
+                                          built[proj])
+                          for proj in order_missed]
+            futures = list(fetched.values()) + list(built.values()) + stored
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+            for future in done:
+                if future.exception() is not None:
+                    raise future.exception()
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+@tracer.span('install_pkgs')
+def install_pkgs(resolver, pkgs_to_check):
+    print("Check and install required packages")
+    ret = resolver.ensure(pkgs_to_check)
+    print('Result {0}.'.format(ret))
 
 
-def prepare_autotools_projects(skip=False):
+@tracer.span('prepare_autotools_projects')
+def prepare_autotools_projects(skip=False, cache=None):
     apr = Project(name='apr',
                   url='http://apache.miloslavbrada.cz/apr/apr-1.5.2.tar.bz2',
-                  dependencies=[])
+                  dependencies=[],
+                  checksum_url='https://archive.apache.org/dist/apr/apr-1.5.2.tar.bz2.md5')  # noqa
     apr_util = Project(name='apr-util',
                        url='http://apache.miloslavbrada.cz/apr/apr-util-1.5.4.tar.bz2',  # noqa
-                       dependencies=[apr])
+                       dependencies=[apr],
+                       checksum_url='https://archive.apache.org/dist/apr/apr-util-1.5.4.tar.bz2.md5')  # noqa
     apache = Project(name='apache',
                      url='http://apache.miloslavbrada.cz/httpd/httpd-2.4.25.tar.bz2',  # noqa
-                     dependencies=[apr, apr_util])
+                     dependencies=[apr, apr_util],
+                     checksum_url='https://archive.apache.org/dist/httpd/httpd-2.4.25.tar.bz2.md5')  # noqa
 
     if not skip:
-        project_builder = ProjectBuilder([apache, apr, apr_util])
+        project_builder = ProjectBuilder([apache, apr, apr_util], cache=cache)
         project_builder.build_all()
 
     return {'apache': apache}
 
 
-def prepare_mod_cluster(work_dir, apache):
+class BuildStepError(Exception):
+    """A step of run_logged() failed"""
+
+    def __init__(self, message, timings):
+        super().__init__(message)
+        self.timings = timings
+
+
+def run_logged(name, steps, cwd, log_path):
+    """Run steps [(command, params)] in cwd, all output into log_path
+
+    Return [(step, seconds)]; raise BuildStepError on the first step
+    that fails.
+    """
+    timings = []
+    with open(log_path, 'w') as log:
+        for command, params in steps:
+            print('{0}: {1} {2}'.format(name, command, ' '.join(params)))
+            log.write('$ {0} {1}\n'.format(command, ' '.join(params)))
+            log.flush()
+            start = monotonic()
+            ret = tracer.call([command] + params, stdout=log, stderr=STDOUT,
+                              cwd=cwd)
+            timings.append((basename(command), monotonic() - start))
+            if ret != 0:
+                raise BuildStepError('{0}: {1} returned [{2}], see {3}'
+                                     .format(name, command, ret, log_path),
+                                     timings)
+    return timings
+
+
+def print_timings(results):
+    """Print step timings of {name: (timings, error)}"""
+    for name, (timings, error) in results.items():
+        steps = ', '.join('{0} {1:.1f}s'.format(step, seconds)
+                          for step, seconds in timings)
+        print('{0:<20} {1:>7.1f}s {2:<6} {3}'.format(
+            name, sum(seconds for _, seconds in timings),
+            'FAILED' if error else 'ok', steps))
+
+
+@tracer.span('prepare_mod_cluster')
+def prepare_mod_cluster(work_dir, apache, fetcher):
     ######################################
     # get, patch, build and install mod_cluster
     ######################################
-    cmd('git', ['clone', 'https://github.com/modcluster/mod_cluster.git'])
+    fetcher.clone(MOD_CLUSTER_REPO, 'mod_cluster')
     chdir('mod_cluster')
     cmd('git', ['checkout', 'origin/1.3.x', '-b', '1.3.x'])
-    chdir('native')
+    mod_cluster_dir = getcwd()
+    native_dir = join(mod_cluster_dir, 'native')
+    log_dir = join(mod_cluster_dir, 'build-logs')
+    makedirs(log_dir, exist_ok=True)
 
     # Patching mod_cluster version to show apache banner
-    # chdir('mod_manager')
-    patch_file(join('mod_manager', 'mod_manager.c'),
+    patch_file(join(native_dir, 'mod_manager', 'mod_manager.c'),
                join(work_dir, 'diffs', 'banner_patch.diff'))
-    # chdir(pardir)
-
-    # build & install
-    for mod in ['mod_proxy_cluster',
-                'mod_manager',
-                'mod_cluster_slotmem',
-                'advertise']:
-        print('Building mod: {0}'.format(mod))
-        chdir(mod)
-        cmd_checked('./buildconf')
-        cmd_checked('./configure',
-                    ['--with-apxs={0}'.format(join(apache.get_install_dir(),
-                                                   'bin', 'apxs'))])
-        cmd_checked('make')
-        cmd_checked('libtool',
-                    ['--finish', join(apache.get_install_dir(), 'modules')])
-
-        # `make install' does nothing; do `cp' instead
-        cmd_checked('cp',
-                    glob('*.so') + [join(apache.get_install_dir(), 'modules')])
-        chdir(pardir)
-
-    # Get mod_cluster config file
-    url = 'https://gist.githubusercontent.com/Karm/85cf36a52a8c203accce/raw/a41ecc90fea1f2b3bb880e79fa67fb6c7f61cf68/mod_cluster.conf'  # noqa
-    # Don't get the file again if it's already around
-    if not exists(basename(url)):
-        cmd_checked('wget', ['--quiet', url, '-O', basename(url)])
-    extra_conf_path = join(apache.get_install_dir(),
-                           'conf', 'extra', basename(url))
-    cmd_checked('cp', [basename(url), extra_conf_path])
-
-    # Update mod_cluster config file
+
+    # Build the native modules, each in its own directory, side by side
+    # with the java libraries; one failure doesn't stop the others
+    modules_dir = join(apache.get_install_dir(), 'modules')
+    apxs = join(apache.get_install_dir(), 'bin', 'apxs')
+    builds = {}
+    with ThreadPoolExecutor(max_workers=len(MOD_CLUSTER_MODULES) + 1) \
+            as executor:
+        builds['mvn package'] = executor.submit(
+            run_logged, 'mvn package', [('mvn', ['package', '-DskipTests'])],
+            mod_cluster_dir, join(log_dir, 'mvn.log'))
+        for mod in MOD_CLUSTER_MODULES:
+            builds[mod] = executor.submit(
+                run_logged, mod,
+                [('./buildconf', []),
+                 ('./configure', ['--with-apxs={0}'.format(apxs)]),
+                 ('make', []),
+                 ('libtool', ['--finish', modules_dir])],
+                join(native_dir, mod), join(log_dir, mod + '.log'))
+
+        results = {}
+        for name, future in builds.items():
+            try:
+                results[name] = (future.result(), None)
+            except BuildStepError as excpt:
+                results[name] = (excpt.timings, excpt)
+
+    print_timings(results)
+    errors = [error for _, error in results.values() if error is not None]
+    for error in errors:
+        print(error)
+    if errors:
+        print('It failed! Bye!')
+        sys.exit(0)
+
+    # `make install' does nothing; do `cp' instead
+    for mod in MOD_CLUSTER_MODULES:
+        cmd_checked('cp', glob(join(native_dir, mod, '*.so')) + [modules_dir])
+
+    # Get mod_cluster config file, with its cache in our apache
     cache_dir = join(apache.get_install_dir(), 'cache')
     if not exists(cache_dir):
         makedirs(cache_dir)
-    cmd_checked('sed',
-                ['-i',
-                 's@MemManagerFile /opt/DU/httpd-build/cache/mod_cluster@MemManagerFile {0}@'  # noqa
-                 .format(join(cache_dir, 'mod_cluster')),
-                 extra_conf_path])
-
-    # Move from mod_cluster/native to mod_cluster and build it's java libraries
-    chdir(pardir)
-    cmd_checked('mvn', ['package', '-DskipTests'])
+    configs.render_file(fetcher.fetch(MOD_CLUSTER_CONF),
+                        join(apache.get_install_dir(), 'conf', 'extra',
+                             MOD_CLUSTER_CONF.name),
+                        configs.MOD_CLUSTER_CONF,
+                        mem_manager_file=join(cache_dir, 'mod_cluster'))
 
 
-def archive_files(packname, file_names):
-    tar_name = "{0}.tar.bz2".format(packname)
-    tar = tar_open(tar_name, "w:bz2")
-    for name in file_names:
-        tar.add(name)
-    tar.close()
-    return tar_name
+@tracer.span('archive_files')
+def archive_files(packname, file_names, previous=None):
+    return archive(packname, file_names, previous)
 
 
 def main():
 
+    args = parser.parse_args()
+    if args.restart_after is not None and (
+            not args.failover_load or args.restart_after <= FAILOVER_KILL):
+        parser.error('--restart-after needs --failover-load and has to be '
+                     'more than {0}s'.format(FAILOVER_KILL))
+
     cleanup = True
+    failover = None
+    regression = False
 
     work_dir = getcwd()
 
@@ -273,96 +522,96 @@ def main():
     tmp_dir = mkdtemp()
     Project.pre_inst_dir = join('/', 'usr', 'local', 'tmp')
     skip = False
+    # Installed apr, apr-util and httpd survive cleanup here
+    build_cache = BuildCache(join(expanduser('~'), '.cache', 'hw', 'builds'))
+    # Downloads and git repositories are kept for later (offline) runs
+    fetcher = Fetcher(join(expanduser('~'), '.cache', 'hw', 'mirror'))
+    Project.fetcher = fetcher
 
     # Setting just for testing...
     # pkgs_to_check = []
     # tmp_dir = getcwd()
     # skip = True
     try:
-        pkg_update()
-        install_pkgs(pkgs_to_check)
+        resolver = PackageResolver()
+        if args.update:
+            pkg_update(resolver)
+        install_pkgs(resolver, pkgs_to_check)
 
         print("Changing to {0}".format(tmp_dir))
         chdir(tmp_dir)
 
         cmd('killall', ['java', 'httpd', 'firewalld'])
 
-        projects = prepare_autotools_projects(skip)
+        # Fetch everything else while apr, apr-util and httpd build
+        for item in [MOD_CLUSTER_REPO, MOD_CLUSTER_CONF, JBOSS_LOGGING_REPO,
+                     CLUSTERBENCH_REPO, TOMCAT]:
+            fetcher.submit(item)
+
+        projects = prepare_autotools_projects(skip, build_cache)
         chdir(tmp_dir)
-        prepare_mod_cluster(work_dir, projects['apache'])
-
-        # Update apache config file
-        conf_path = join(projects['apache'].get_install_dir(),
-                         'conf', 'httpd.conf')
-        patch_file(conf_path, join(work_dir, 'diffs', 'httpd_patch.diff'))
-
-        # Get and build jboss logging
-        chdir(pardir)
-        cmd('git', ['clone', 'https://github.com/jboss-logging/jboss-logging.git'])
-        chdir('jboss-logging')
-        cmd_checked('mvn', ['package', '-DskipTests'])
-
-        chdir(pardir)
-
-        # Get and build clusterbench
-        cmd('git', ['clone', 'https://github.com/Karm/clusterbench.git'])
-        chdir('clusterbench')
-        cmd('git', ['checkout', 'origin/simplified-and-pure', '-b', 'sp'])
-        cmd('mvn', ['clean', 'install', '-Pee6', '-DskipTests'])
-
-        chdir(pardir)
-
-        # Get and unpack tomcat
-        turl = 'https://archive.apache.org/dist/tomcat/tomcat-7/v7.0.73/bin/apache-tomcat-7.0.73.tar.gz'  # noqa
-        if not exists(basename(turl)):
-            cmd('wget', ['--quiet', turl])
-            cmd('tar', ['xzf', basename(turl)])
-            tomcat_dir = splitext(splitext(basename(turl))[0])[0]
-
-        # Install mod_cluster and jboss logging into tomcat
-        cmd_checked('cp', [
-            glob(join('mod_cluster', 'container', 'tomcat8', 'target',
-                      'mod_cluster-container-tomcat8-*-SNAPSHOT.jar'))[0],
-            glob(join('mod_cluster', 'container', 'catalina-standalone', 'target',
-                      'mod_cluster-container-catalina-standalone-*-SNAPSHOT.jar'))[0],  # noqa
-            glob(join('mod_cluster', 'container', 'catalina', 'target',
-                      'mod_cluster-container-catalina-*-SNAPSHOT.jar'))[0],
-            glob(join('mod_cluster', 'core', 'target',
-                      'mod_cluster-core-*-SNAPSHOT.jar'))[0],
-            glob(join('mod_cluster', 'container-spi', 'target',
-                      'mod_cluster-container-spi-*-SNAPSHOT.jar'))[0],
-            glob(join('jboss-logging', 'target',
-                      'jboss-logging-*-SNAPSHOT.jar'))[0],
-            join(tomcat_dir, 'lib')])
-
-        # Install clusterbench into tomcat
-        cmd_checked('cp', [join('clusterbench', 'clusterbench-ee6-web',
-                                'target', 'clusterbench.war'),
-                           join(tomcat_dir, 'webapps')])
-
-        ip_address = get_ip4_address()
-
-        patch_file(join(tomcat_dir, 'conf', 'server.xml'),
-                   join(work_dir, 'diffs', 'tomcat1_patch.diff'),
-                   template=[ip_address, 'tomcat1'])
-
-        apache_tomcat_inst_dir_1 = join(Project.pre_inst_dir, tomcat_dir)
-
-        # Copy tomcat to the same directory as apache
-        cmd('cp', ['-r', tomcat_dir, Project.pre_inst_dir])
-
-        patch_file(join(tomcat_dir, 'conf', 'server.xml'),
-                   join(work_dir, 'diffs', 'tomcat2_patch.diff'),
-                   template=[ip_address, 'tomcat1', 'tomcat2'])
-
-        apache_tomcat_inst_dir_2 = join(Project.pre_inst_dir, 'at2')
-        if not exists(apache_tomcat_inst_dir_2):
-            makedirs(apache_tomcat_inst_dir_2)
-
-        # Copy 2nd tomcat to the same directory as apache
-        chdir(tomcat_dir)
-        cmd('cp', ['-r'] + glob('*') + [apache_tomcat_inst_dir_2])
-        chdir(pardir)
+        prepare_mod_cluster(work_dir, projects['apache'], fetcher)
+
+        # Update apache config file, starting from the pristine one
+        conf_dir = join(projects['apache'].get_install_dir(), 'conf')
+        configs.render_file(join(conf_dir, 'original', 'httpd.conf'),
+                            join(conf_dir, 'httpd.conf'), configs.HTTPD_CONF)
+
+        with tracer.span('jboss-logging'):
+            # Get and build jboss logging
+            chdir(pardir)
+            fetcher.clone(JBOSS_LOGGING_REPO, 'jboss-logging')
+            chdir('jboss-logging')
+            cmd_checked('mvn', ['package', '-DskipTests'])
+
+            chdir(pardir)
+
+        with tracer.span('clusterbench'):
+            # Get and build clusterbench
+            fetcher.clone(CLUSTERBENCH_REPO, 'clusterbench')
+            chdir('clusterbench')
+            cmd('git', ['checkout', 'origin/simplified-and-pure', '-b', 'sp'])
+            cmd('mvn', ['clean', 'install', '-Pee6', '-DskipTests'])
+
+            chdir(pardir)
+
+        with tracer.span('tomcat setup'):
+            # Get and unpack tomcat
+            tomcat_dir = splitext(splitext(TOMCAT.name)[0])[0]
+            if not exists(tomcat_dir):
+                cmd('tar', ['xzf', fetcher.fetch(TOMCAT)])
+
+            # Install mod_cluster and jboss logging into tomcat
+            cmd_checked('cp', [
+                glob(join('mod_cluster', 'container', 'tomcat8', 'target',
+                          'mod_cluster-container-tomcat8-*-SNAPSHOT.jar'))[0],
+                glob(join('mod_cluster', 'container', 'catalina-standalone',
+                          'target',
+                          'mod_cluster-container-catalina-standalone-*-SNAPSHOT.jar'))[0],  # noqa
+                glob(join('mod_cluster', 'container', 'catalina', 'target',
+                          'mod_cluster-container-catalina-*-SNAPSHOT.jar'))[0],
+                glob(join('mod_cluster', 'core', 'target',
+                          'mod_cluster-core-*-SNAPSHOT.jar'))[0],
+                glob(join('mod_cluster', 'container-spi', 'target',
+                          'mod_cluster-container-spi-*-SNAPSHOT.jar'))[0],
+                glob(join('jboss-logging', 'target',
+                          'jboss-logging-*-SNAPSHOT.jar'))[0],
+                join(tomcat_dir, 'lib')])
+
+            # Install clusterbench into tomcat
+            cmd_checked('cp', [join('clusterbench', 'clusterbench-ee6-web',
+                                    'target', 'clusterbench.war'),
+                               join(tomcat_dir, 'webapps')])
+
+            ip_address = get_ip4_address()
+
+            # Copy tomcat to the same directory as apache; it's the
+            # CATALINA_HOME all nodes share
+            cmd('cp', ['-r', tomcat_dir, Project.pre_inst_dir])
+            topology = Topology(join(Project.pre_inst_dir, tomcat_dir),
+                                join(Project.pre_inst_dir, 'nodes'),
+                                args.nodes, ip_address)
+            topology.build()
 
         # Set firewall - just for now
         # cmd_checked('firewall-cmd', ['--add-service=http'])
@@ -375,28 +624,36 @@ def main():
 
         cmd('setenforce', ['0'])
 
-        # (re)Start apache
-        cmd_checked(join(projects['apache'].get_install_dir(),
-                         'bin', 'apachectl'), ['start'])
-
-        apache1_tomcat_pid_path = join(apache_tomcat_inst_dir_1, 'pids', 'pid')
-        apache2_tomcat_pid_path = join(apache_tomcat_inst_dir_2, 'pids', 'pid')
-
-        if not exists(dirname(apache1_tomcat_pid_path)):
-            makedirs(dirname(apache1_tomcat_pid_path))
-        if not exists(dirname(apache2_tomcat_pid_path)):
-            makedirs(dirname(apache2_tomcat_pid_path))
-
-        touch(apache1_tomcat_pid_path)
-        touch(apache2_tomcat_pid_path)
-
-        # Start tomcat
-        cmd_checked(join(apache_tomcat_inst_dir_1, 'bin', 'catalina.sh'),
-                    ['start'],
-                    env={**dict(environ), 'CATALINA_PID': apache1_tomcat_pid_path})
-        cmd_checked(join(apache_tomcat_inst_dir_2, 'bin', 'catalina.sh'),
-                    ['start'],
-                    env={**dict(environ), 'CATALINA_PID': apache2_tomcat_pid_path})
+        proxy_url = 'http://{0}:6666'.format(ip_address)
+        clusterbench_url = proxy_url + '/clusterbench/requestinfo'
+
+        # (re)Start apache and tomcats all at once; a tomcat is ready when
+        # it listens, has registered with the proxy over MCMP and serves
+        # clusterbench itself (through the proxy any node may answer)
+        def tomcat_service(node):
+            return Service(
+                node.route,
+                partial(cmd_checked, node.catalina(), ['start'],
+                        env=node.env(environ)),
+                [TcpProbe(ip_address, node.http_port),
+                 TcpProbe(ip_address, node.ajp_port),
+                 # The AJP address is unique where the route may not be
+                 # (tomcat1 is in tomcat10)
+                 HttpProbe(proxy_url + '/mod_cluster_manager',
+                           text='{0}:{1}'.format(ip_address, node.ajp_port),
+                           name='mcmp registration'),
+                 HttpProbe('http://{0}:{1}/clusterbench/requestinfo'.format(
+                     ip_address, node.http_port), name='clusterbench 200')])
+
+        orchestrator = Orchestrator(
+            [Service('apache',
+                     partial(cmd_checked,
+                             join(projects['apache'].get_install_dir(),
+                                  'bin', 'apachectl'), ['start']),
+                     [TcpProbe(ip_address, 6666)])] +
+            [tomcat_service(node) for node in topology.nodes])
+        with tracer.span('startup'):
+            print_report(orchestrator.start_all())
 
         def get_jvm_route(fdesc):
             data = fdesc.read().decode('utf-8')
@@ -406,51 +663,89 @@ def main():
                     return line[idx+1:].strip()
             return None
 
-        clusterbench_url = 'http://{0}:6666/clusterbench/requestinfo'\
-                           .format(ip_address)
-        # Use session cookie
-        opener = build_opener(HTTPCookieProcessor(http.cookiejar.CookieJar()))
-        install_opener(opener)
-
-        req = Request(url=clusterbench_url)
-
-        timeout = 120
-        # Be sure that server is up
-        for seconds in range(timeout):
-            try:
-                fdesc = urlopen(req)
-                if fdesc.getcode() == 200:
-                    jvm_route = get_jvm_route(fdesc)
-                    fdesc.close()
-                    break
-            except HTTPError as excpt:
-                sleep(1)
-                print('Waiting for server...{0} - {1}'.format(timeout-seconds, excpt.code))
-        else:
-            assert False, "Server is not up."
-
-        for _ in range(5):
-            with urlopen(req) as fdesc:
+        def request_route(opener):
+            with opener.open(clusterbench_url) as fdesc:
                 assert fdesc.getcode() == 200
-                # session cookies do work
-                assert get_jvm_route(fdesc) == jvm_route
-
-        # kill tomcat
-        if jvm_route == 'tomcat1':
-            fname = apache1_tomcat_pid_path
-            exp_jvm_route = 'tomcat2'
-        else:
-            fname = apache2_tomcat_pid_path
-            exp_jvm_route = 'tomcat1'
-
-        with open(fname, 'r') as fdesc:
-            pid = int(fdesc.read())
-            kill(pid, SIGKILL)
-
-        # check that new tomcat is used
-        with urlopen(req) as fdesc:
-            assert fdesc.getcode() == 200
-            assert get_jvm_route(fdesc) == exp_jvm_route
+                return get_jvm_route(fdesc)
+
+        if args.bench:
+            with tracer.span('benchmark'):
+                store = ResultStore(join(expanduser('~'), '.cache', 'hw',
+                                         'bench-results.jsonl'))
+                tags = {'httpd': projects['apache'].get_unpack_dir(),
+                        'tomcat': tomcat_dir,
+                        'mod_cluster': check_output(
+                            ['git', 'rev-parse', '--short', 'HEAD'],
+                            cwd=join(tmp_dir, 'mod_cluster'),
+                            universal_newlines=True).strip(),
+                        'nodes': str(len(topology.nodes))}
+                results = run_suite(clusterbench_url, PROFILES, 3)
+                # Not fatal; the rest is checked and archived all the same
+                regression = not gate(
+                    store, clusterbench_url, results, args.bench, 5.0, tags,
+                    args.bench if store.baseline(args.bench) is None
+                    else None)
+
+        with tracer.span('verification'):
+            # Sessions, each with its own cookie; twice as many as nodes
+            # so that they spread over all of them
+            openers = [build_opener(
+                HTTPCookieProcessor(http.cookiejar.CookieJar()))
+                       for _ in range(2 * len(topology.nodes))]
+            routes = [request_route(opener) for opener in openers]
+            for _ in range(5):
+                for opener, jvm_route in zip(openers, routes):
+                    # session cookies do work
+                    assert request_route(opener) == jvm_route
+            print('Sessions per node: {0}'.format(
+                ', '.join('{0}: {1}'.format(node.route,
+                                            routes.count(node.route))
+                          for node in topology.nodes)))
+            if len(topology.nodes) > 1:
+                assert len(set(routes)) > 1, 'All sessions on one node'
+
+            # kill tomcats, under load if asked for
+            restarted = False
+            if args.failover_load:
+                def kill():
+                    return [node.route for node in topology.kill_random()]
+
+                def restart(routes):
+                    for route in routes:
+                        node = topology.node(route)
+                        cmd_checked(node.catalina(), ['start'],
+                                    env=node.env(environ))
+
+                with tracer.span('failover under load'):
+                    load, failover = measure(
+                        {'url': clusterbench_url,
+                         'cli_num': 10 * len(topology.nodes),
+                         'rate': 200.0 * len(topology.nodes),
+                         'engine': 'asyncio'},
+                        kill, FAILOVER_KILL, FAILOVER_DURATION,
+                        restart if args.restart_after else None,
+                        args.restart_after)
+                load.report()
+                print(failover.report())
+                kill_time = failover.kill_epoch
+                killed = failover.killed
+                restarted = failover.restart is not None
+            else:
+                kill_time = time()
+                killed = {node.route for node in topology.kill_random()}
+
+            # check that sessions of killed tomcats fail over to live ones
+            # and the others stay where they were
+            for opener, jvm_route in zip(openers, routes):
+                new_route = request_route(opener)
+                if jvm_route in killed:
+                    # Restarted nodes may take their sessions' routes back
+                    assert restarted or new_route not in killed, \
+                        '{0} still served by a killed node'.format(jvm_route)
+                else:
+                    assert new_route == jvm_route, \
+                        'Session moved from {0} to {1}'.format(jvm_route,
+                                                               new_route)
 
     except Exception as exp:
         if input("Unexpected error - {2}; Do you want to keep: {0} and {1}, type y/n".format(tmp_dir, Project.pre_inst_dir, exp)) == 'y':
@@ -458,20 +753,48 @@ def main():
     else:
         apache = projects['apache']
         files = [join(apache.get_install_dir(), 'conf'),
-                 join(apache.get_install_dir(), 'logs'),
-                 join(apache_tomcat_inst_dir_1, 'conf'),
-                 join(apache_tomcat_inst_dir_1, 'logs'),
-                 join(apache_tomcat_inst_dir_2, 'conf'),
-                 join(apache_tomcat_inst_dir_2, 'logs')]
+                 join(apache.get_install_dir(), 'logs')]
+        for node in topology.nodes:
+            files += [join(node.base, 'conf'), join(node.base, 'logs')]
 
         arch_name = join('/', 'tmp', 'artefacts-' + strftime("%Y%m%d-%H%M%S"))
-        print('Generating: ' + archive_files(arch_name, files))
-        print('All green!')
+        with tracer.span('log analysis'):
+            analysis = analyze(
+                [join(apache.get_install_dir(), 'logs', 'access_log')],
+                {node.route: sorted(glob(join(node.base, 'logs',
+                                              'localhost_access_log.*')))
+                 for node in topology.nodes},
+                kill_time)
+            print(analysis.report())
+            with open(arch_name + '.logs.json', 'w') as fdesc:
+                json.dump(analysis.to_dict(), fdesc, indent=2)
+            if failover is not None:
+                with open(arch_name + '.failover.json', 'w') as fdesc:
+                    json.dump({'load': load.to_dict(),
+                               'failover': failover.to_dict()}, fdesc,
+                              indent=2)
+
+        # Leave out what the previous artefacts already have
+        previous = latest_manifest(join('/', 'tmp', 'artefacts-*')) \
+            if args.incremental else None
+        print('Generating: ' + archive_files(arch_name, files, previous))
+        if regression:
+            print('Performance regression against {0}'.format(args.bench))
+        else:
+            print('All green!')
 
     finally:
+        fetcher.close()
+        trace_name = join('/', 'tmp',
+                          'hw-trace-' + strftime("%Y%m%d-%H%M%S") + '.json')
+        tracer.export(trace_name)
+        print(tracer.summary())
+        print('Trace written to: ' + trace_name)
         if cleanup:
             rmtree(tmp_dir)
             rmtree(Project.pre_inst_dir)
+    if regression:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
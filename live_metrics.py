@@ -0,0 +1,202 @@
+"""Interval metrics of a running req_send.py load
+
+Clients only ever touch their own Stats: plain counters and a list the
+latency of every response is appended to. A reporter thread sums the
+counters and swaps the lists out every interval, so nothing on the
+send/receive path takes a lock. A sample appended right at the swap may
+miss its interval; the cumulative histograms in Stats are unaffected.
+
+Intervals can be printed, passed to a parent process (worker mode) and
+served in Prometheus text exposition format.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Event
+from time import monotonic
+
+from histogram import Histogram
+
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class Interval:
+    """Metrics of one reporting interval"""
+
+    def __init__(self):
+        self.elapsed = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.server_errors = 0
+        self.active = 0
+        self.latency = Histogram()
+
+    def merge(self, other):
+        """Add an interval of the same time span measured elsewhere"""
+        self.elapsed = max(self.elapsed, other.elapsed)
+        self.requests += other.requests
+        self.errors += other.errors
+        self.server_errors += other.server_errors
+        self.active += other.active
+        self.latency.merge(other.latency)
+
+    def throughput(self):
+        """Responses per second"""
+        return self.latency.count / self.elapsed if self.elapsed else 0.0
+
+    def format(self, since):
+        return '[{0:7.1f}s] {1:9.1f} resp/s, errors: {2}, server errors: ' \
+               '{3}, active connections: {4}, {5}'\
+               .format(since, self.throughput(), self.errors,
+                       self.server_errors, self.active, self.latency.format())
+
+
+class Collector:
+    """Turns cumulative per-client Stats into Interval deltas"""
+
+    def __init__(self, stats):
+        self.stats = stats
+        for client_stats in stats:
+            client_stats.window = []
+        self.last = monotonic()
+        self.requests = 0
+        self.errors = 0
+        self.server_errors = 0
+
+    def collect(self):
+        interval = Interval()
+        requests = errors = server_errors = 0
+        for client_stats in self.stats:
+            requests += client_stats.requests
+            errors += client_stats.errors
+            server_errors += client_stats.server_errors
+            interval.active += client_stats.active
+            window, client_stats.window = client_stats.window, []
+            for seconds in window:
+                interval.latency.record_seconds(seconds)
+
+        now = monotonic()
+        interval.elapsed = now - self.last
+        interval.requests = requests - self.requests
+        interval.errors = errors - self.errors
+        interval.server_errors = server_errors - self.server_errors
+        self.last = now
+        self.requests = requests
+        self.errors = errors
+        self.server_errors = server_errors
+        return interval
+
+
+class Reporter(Thread):
+    """Calls sink with an Interval every period seconds until stopped
+
+    The source is either a Collector or a callable returning the Interval
+    (e.g. merged from worker processes).
+    """
+
+    def __init__(self, source, period, sink):
+        super().__init__(daemon=True)
+        self.source = source
+        self.period = period
+        self.sink = sink
+        self.stopped = Event()
+
+    def run(self):
+        while not self.stopped.wait(self.period):
+            self.emit()
+
+    def emit(self):
+        if isinstance(self.source, Collector):
+            self.sink(self.source.collect())
+        else:
+            self.sink(self.source())
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class Printer:
+    """Sink printing one line per interval"""
+
+    def __init__(self, exporter=None):
+        self.start = monotonic()
+        self.exporter = exporter
+
+    def __call__(self, interval):
+        print(interval.format(monotonic() - self.start), flush=True)
+        if self.exporter is not None:
+            self.exporter.update(interval)
+
+
+class PrometheusExporter:
+    """Serves the latest metrics in Prometheus text format on /metrics"""
+
+    def __init__(self, port, host=''):
+        self.requests = 0
+        self.errors = 0
+        self.server_errors = 0
+        self.responses = 0
+        self.latency_sum = 0.0
+        self.text = self.render(Interval())
+        exporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = exporter.text.encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def update(self, interval):
+        self.requests += interval.requests
+        self.errors += interval.errors
+        self.server_errors += interval.server_errors
+        self.responses += interval.latency.count
+        self.latency_sum += interval.latency.total / 1000000
+        self.text = self.render(interval)
+
+    def render(self, interval):
+        lines = [
+            '# HELP reqsend_requests_total Requests sent.',
+            '# TYPE reqsend_requests_total counter',
+            'reqsend_requests_total {0}'.format(self.requests),
+            '# HELP reqsend_errors_total Requests that got no response.',
+            '# TYPE reqsend_errors_total counter',
+            'reqsend_errors_total {0}'.format(self.errors),
+            '# HELP reqsend_server_errors_total Responses with 5xx status.',
+            '# TYPE reqsend_server_errors_total counter',
+            'reqsend_server_errors_total {0}'.format(self.server_errors),
+            '# HELP reqsend_active_connections Open client connections.',
+            '# TYPE reqsend_active_connections gauge',
+            'reqsend_active_connections {0}'.format(interval.active),
+            '# HELP reqsend_throughput Responses per second in the last '
+            'interval.',
+            '# TYPE reqsend_throughput gauge',
+            'reqsend_throughput {0}'.format(interval.throughput()),
+            '# HELP reqsend_latency_seconds Response latency, quantiles over '
+            'the last interval.',
+            '# TYPE reqsend_latency_seconds summary']
+        for quantile in QUANTILES:
+            lines.append('reqsend_latency_seconds{{quantile="{0}"}} {1}'
+                         .format(quantile,
+                                 interval.latency.percentile(quantile * 100)
+                                 / 1000000))
+        lines.append('reqsend_latency_seconds_sum {0}'.format(self.latency_sum))
+        lines.append('reqsend_latency_seconds_count {0}'.format(self.responses))
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
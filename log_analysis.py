@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""Post-run analysis of httpd and tomcat access logs
+
+Logs are memory-mapped and read a line at a time, so even multi-GB logs
+of long load runs are never loaded whole; big ones are split into
+ranges of lines scanned by several processes. Lines are expected in common
+or combined log format (httpd's and tomcat's AccessLogValve defaults),
+optionally followed by %D: the time taken in microseconds, which gives
+proxy-side latency percentiles.
+
+Reported are requests per backend (lines of each tomcat's own log,
+counted without parsing them), status
+codes at the proxy and, given the time nodes were killed, the failover
+gap: from the kill until the first second without failures (5xx) that
+follows the first failure, and how many requests failed meanwhile. %t
+has a resolution of a second, so does the gap; lines of the second of
+the kill may be from before it and are left out.
+"""
+
+import argparse
+import json
+import mmap
+import sys
+from datetime import datetime
+from glob import glob
+from multiprocessing import Pool
+from os import cpu_count
+from os.path import getsize
+
+from histogram import Histogram
+
+CHUNK_SIZE = 16 * 1024 * 1024
+
+parser = argparse.ArgumentParser(
+    description='Analyze httpd and tomcat access logs of a run.')
+
+parser.add_argument('--proxy-log', metavar='file', action='append',
+                    default=[], help='Access log of the proxy')
+parser.add_argument('--backend-log', metavar='route=glob', action='append',
+                    default=[],
+                    help='Access logs of the backend with route')
+parser.add_argument('--kill-time', metavar='epoch', type=float, default=None,
+                    help='When nodes were killed (seconds since epoch)')
+parser.add_argument('--json', metavar='file',
+                    help='Write results as JSON to file ("-" for stdout)')
+
+
+class TimeParser:
+    """Parses %t timestamps, remembering the last one
+
+    Consecutive lines mostly share the second they were logged in.
+    """
+
+    def __init__(self):
+        self.last = None
+        self.value = None
+
+    def __call__(self, stamp):
+        if stamp != self.last:
+            self.value = datetime.strptime(
+                stamp.decode('ascii'), '%d/%b/%Y:%H:%M:%S %z').timestamp()
+            self.last = stamp
+        return self.value
+
+
+def count_lines(path):
+    if getsize(path) == 0:
+        return 0
+    lines = 0
+    with open(path, 'rb') as fdesc:
+        with mmap.mmap(fdesc.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for offset in range(0, len(data), CHUNK_SIZE):
+                lines += data[offset:offset + CHUNK_SIZE].count(b'\n')
+    return lines
+
+
+def split_ranges(path, parts):
+    """Split path into up to parts (start, stop) ranges of whole lines"""
+    size = getsize(path)
+    if size == 0:
+        return []
+    bounds = [0]
+    with open(path, 'rb') as fdesc:
+        with mmap.mmap(fdesc.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for i in range(1, parts):
+                newline = data.find(b'\n', max(bounds[-1], size * i // parts))
+                if newline < 0:
+                    break
+                bounds.append(newline + 1)
+    bounds.append(size)
+    return [(start, stop) for start, stop in zip(bounds, bounds[1:])
+            if start < stop]
+
+
+def scan_range(path, start, stop, kill_second=None):
+    """Counts over the access log lines of path from start to stop
+
+    Return (statuses, latencies, after): requests per status, per %D
+    value and [successful, failed] requests per second from kill_second
+    on.
+    """
+    parse_time = TimeParser()
+    statuses = {}
+    latencies = {}
+    after = {}
+    with open(path, 'rb') as fdesc:
+        with mmap.mmap(fdesc.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            data.seek(start)
+            readline = data.readline
+            while data.tell() < stop:
+                line = readline()
+                # ... [%t] "%r" %>s %b ...
+                end = line.find(b'] "')
+                if end < 0:
+                    continue
+                quote_end = line.find(b'" ', end + 3)
+                if quote_end < 0:
+                    continue
+                fields = line[quote_end + 2:].split()
+                if not fields or not fields[0].isdigit():
+                    continue
+                status = fields[0]
+                statuses[status] = statuses.get(status, 0) + 1
+                # %D is last, after %b (common) or the quoted user agent
+                # (combined)
+                if len(fields) > 2 and fields[-1].isdigit():
+                    latencies[fields[-1]] = latencies.get(fields[-1], 0) + 1
+                if kill_second is None:
+                    continue
+                logged = parse_time(line[line.find(b'[') + 1:end])
+                if logged < kill_second:
+                    continue
+                counts = after.get(logged)
+                if counts is None:
+                    counts = after[logged] = [0, 0]
+                counts[status[0:1] == b'5'] += 1
+    return ({int(status): count for status, count in statuses.items()},
+            {int(micros): count for micros, count in latencies.items()},
+            after)
+
+
+class Analysis:
+    """Statistics over the logs of one run
+
+    Proxy logs bigger than PARALLEL_SIZE are scanned in byte ranges by a
+    pool of processes, one per CPU.
+    """
+
+    PARALLEL_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, kill_time=None, processes=None):
+        self.kill_time = kill_time
+        self.processes = processes or cpu_count() or 1
+        self.backends = {}
+        self.statuses = {}
+        self.latency = Histogram()
+        self.proxy_requests = 0
+        # second -> [successful, failed] after the kill
+        self.after = {}
+
+    def add_proxy_log(self, paths):
+        # %t is in whole seconds; the second of the kill is partly
+        # before it
+        kill_second = int(self.kill_time) + 1 \
+            if self.kill_time is not None else None
+        jobs = []
+        for path in paths:
+            parts = self.processes \
+                if getsize(path) > self.PARALLEL_SIZE else 1
+            jobs += [(path, start, stop, kill_second)
+                     for start, stop in split_ranges(path, parts)]
+        if len(jobs) > 1 and self.processes > 1:
+            with Pool(min(self.processes, len(jobs))) as pool:
+                results = pool.starmap(scan_range, jobs)
+        else:
+            results = [scan_range(*job) for job in jobs]
+
+        for statuses, latencies, after in results:
+            for status, count in statuses.items():
+                self.statuses[status] = self.statuses.get(status, 0) + count
+                self.proxy_requests += count
+            # Latencies repeat a lot; into the histogram once per value
+            for micros, count in latencies.items():
+                self.latency.record(micros, count)
+            for second, (ok, failed) in after.items():
+                counts = self.after.setdefault(second, [0, 0])
+                counts[0] += ok
+                counts[1] += failed
+
+    def add_backend_log(self, route, paths):
+        requests = sum(count_lines(path) for path in paths)
+        self.backends[route] = self.backends.get(route, 0) + requests
+
+    def first_failure(self):
+        failing = [second for second, (ok, failed) in self.after.items()
+                   if failed]
+        return min(failing) if failing else None
+
+    def recovery(self):
+        """First second with successes and no failures after the first
+        failure; None if there was none"""
+        first = self.first_failure()
+        if first is None:
+            return None
+        # Sessions on surviving nodes succeed all along; only a second
+        # without failures means the proxy is through
+        for second in sorted(self.after):
+            ok, failed = self.after[second]
+            if second > first and ok and not failed:
+                return second
+        return None
+
+    def failed_after_kill(self):
+        """Requests that failed from the first failure until recovery"""
+        first = self.first_failure()
+        if first is None:
+            return 0
+        recovered = self.recovery()
+        return sum(failed for second, (ok, failed) in self.after.items()
+                   if second >= first
+                   and (recovered is None or second < recovered))
+
+    def failover_gap(self):
+        """Seconds from the kill to recovery, 0 without failures"""
+        if self.kill_time is None:
+            return None
+        if self.first_failure() is None:
+            return 0.0
+        recovered = self.recovery()
+        if recovered is None:
+            return None
+        return recovered - self.kill_time
+
+    def to_dict(self):
+        return {'proxy_requests': self.proxy_requests,
+                'backends': self.backends,
+                'statuses': {str(status): count for status, count
+                             in sorted(self.statuses.items())},
+                'latency_us': self.latency.summary()
+                if self.latency.count else None,
+                'failover_gap_s': self.failover_gap(),
+                'failed_after_kill': self.failed_after_kill()}
+
+    def report(self):
+        lines = ['Requests at proxy: {0}'.format(self.proxy_requests)]
+        total = sum(self.backends.values())
+        for route, count in sorted(self.backends.items()):
+            lines.append('  {0:<12} {1:>10} {2:>6.1f}%'.format(
+                route, count, 100.0 * count / total if total else 0.0))
+        lines.append('Status codes: {0}'.format(', '.join(
+            '{0}: {1}'.format(status, count)
+            for status, count in sorted(self.statuses.items()))))
+        if self.latency.count:
+            lines.append('Proxy latency: {0}'.format(self.latency.format()))
+        if self.kill_time is not None:
+            gap = self.failover_gap()
+            lines.append('Failover gap: {0}, {1} failed requests meanwhile'
+                         .format('{0:.0f}s (1s log resolution)'.format(gap)
+                                 if gap is not None else 'no recovery',
+                                 self.failed_after_kill()))
+        return '\n'.join(lines)
+
+
+def analyze(proxy_logs, backend_logs, kill_time=None):
+    """Analysis of proxy log paths and {route: [paths]} of backends"""
+    analysis = Analysis(kill_time)
+    analysis.add_proxy_log(proxy_logs)
+    for route, paths in backend_logs.items():
+        analysis.add_backend_log(route, paths)
+    return analysis
+
+
+if __name__ == '__main__':
+
+    args = parser.parse_args()
+    backend_logs = {}
+    for spec in args.backend_log:
+        route, _, pattern = spec.partition('=')
+        backend_logs.setdefault(route, []).extend(sorted(glob(pattern)))
+
+    analysis = analyze(args.proxy_log, backend_logs, args.kill_time)
+    print(analysis.report())
+    if args.json:
+        data = json.dumps(analysis.to_dict(), indent=2)
+        if args.json == '-':
+            sys.stdout.write(data + '\n')
+        else:
+            with open(args.json, 'w') as fdesc:
+                fdesc.write(data + '\n')
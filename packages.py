@@ -0,0 +1,123 @@
+"""Batched resolution and installation of system packages
+
+All packages are looked up in one query and the missing ones installed
+in one transaction. What is known to be installed is remembered, so
+asking again during the same run costs nothing. Backends are plain
+classes with installed(), install() and update(); StubBackend stands in
+for a package manager when trying things out. The examples in the
+docstrings run with `python3 -m doctest packages.py'.
+"""
+
+from subprocess import DEVNULL
+from tempfile import TemporaryFile
+
+from tracing import tracer
+
+# rpm -q prints "package <name> is not installed" on stdout too
+INSTALLED_MARKER = 'installed '
+
+
+def parse_installed(output):
+    """Names in rpm -q output queried with INSTALLED_MARKER
+
+    >>> sorted(parse_installed('installed gcc\\n'
+    ...                        'package maven is not installed\\n'
+    ...                        'installed git\\n'))
+    ['gcc', 'git']
+    """
+    return {line[len(INSTALLED_MARKER):].strip()
+            for line in output.splitlines()
+            if line.startswith(INSTALLED_MARKER)}
+
+
+class DnfBackend:
+    """rpm database queries, dnf transactions"""
+
+    def installed(self, names):
+        """Return the subset of names that is installed"""
+        # A file rather than a pipe, tracer.call() only waits
+        with TemporaryFile('w+') as output:
+            tracer.call(['rpm', '-q', '--queryformat',
+                         INSTALLED_MARKER + '%{NAME}\\n'] + list(names),
+                        stdout=output, stderr=DEVNULL)
+            output.seek(0)
+            found = parse_installed(output.read())
+        return {name for name in names if name in found}
+
+    def install(self, names):
+        print('dnf install -y {0}'.format(' '.join(names)))
+        return tracer.call(['dnf', 'install', '-y'] + list(names)) == 0
+
+    def update(self):
+        print('dnf update -y')
+        return tracer.call(['dnf', 'update', '-y']) == 0
+
+
+class StubBackend:
+    """Package manager pretending to have installed packages"""
+
+    def __init__(self, installed=(), broken=()):
+        self.packages = set(installed)
+        self.broken = set(broken)
+        self.calls = []
+
+    def installed(self, names):
+        self.calls.append(('installed', sorted(names)))
+        return self.packages & set(names)
+
+    def install(self, names):
+        self.calls.append(('install', sorted(names)))
+        if self.broken & set(names):
+            return False
+        self.packages.update(names)
+        return True
+
+    def update(self):
+        self.calls.append(('update', []))
+        return True
+
+
+class PackageResolver:
+    """Makes sure packages are installed, asking backend as little as
+    possible
+
+    >>> backend = StubBackend(installed=['gcc'])
+    >>> resolver = PackageResolver(backend)
+    >>> resolver.ensure(['gcc', 'git', 'maven'])
+    Installing git, maven
+    True
+    >>> resolver.ensure(['gcc', 'git'])
+    All of gcc, git installed
+    True
+    >>> backend.calls
+    [('installed', ['gcc', 'git', 'maven']), ('install', ['git', 'maven'])]
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend or DnfBackend()
+        self.known = set()
+
+    def missing(self, names):
+        """Return names not installed, in the order given"""
+        unknown = [name for name in names if name not in self.known]
+        if unknown:
+            self.known.update(self.backend.installed(unknown))
+        return [name for name in names if name not in self.known]
+
+    def ensure(self, names):
+        """Install whatever of names is missing; True when all are there"""
+        missing = self.missing(names)
+        if not missing:
+            print('All of {0} installed'.format(', '.join(names)))
+            return True
+        print('Installing {0}'.format(', '.join(missing)))
+        if self.backend.install(missing):
+            self.known.update(missing)
+            return True
+        # Part of the transaction may still have gone through
+        self.known.update(self.backend.installed(missing))
+        return all(name in self.known for name in names)
+
+    def update(self):
+        """Update the whole system; what's installed stays installed"""
+        return self.backend.update()
@@ -2,12 +2,27 @@
 
 from socket import socket
 from threading import Thread
-from sys import exit
+from multiprocessing import Pool, Manager
+from queue import Empty
+from time import monotonic, perf_counter, sleep
+from random import random, expovariate
+import asyncio
+import json
+import os
+import resource
+from sys import exit, stderr, stdout
+from contextlib import redirect_stdout
 from datetime import datetime
 from urllib.parse import urlparse
 from re import match
 import argparse
 
+from histogram import Histogram
+from live_metrics import (Collector, Interval, Printer, PrometheusExporter,
+                          Reporter)
+from http_parser import ResponseParser, ParseError
+from workload import Workload, WorkloadError, check as check_workload
+
 parser = argparse.ArgumentParser(
     description='Send N requests on URL from X clients.')
 
@@ -19,6 +34,38 @@ parser.add_argument('-X', metavar='n', type=int, default=1,
                     help='Number of clients')
 parser.add_argument('--timeout', metavar='microseconds', type=int, default=-1,
                     help='Number of microseconds for which sesssion cookie is valid')
+parser.add_argument('--rate', metavar='r', type=float, default=None,
+                    help='Send r requests per second in total on a fixed '
+                    'schedule instead of waiting for each response')
+parser.add_argument('--poisson',
+                    help='With --rate, space requests as Poisson arrivals',
+                    action='store_true')
+parser.add_argument('--engine', choices=['threads', 'asyncio'],
+                    default='threads',
+                    help='Run clients as OS threads or as asyncio tasks')
+parser.add_argument('--workers', metavar='n', type=int, default=1,
+                    help='Number of processes the clients are spread over')
+parser.add_argument('--affinity',
+                    help='Check that sessions stick to the backend reported '
+                    'as "JVM route" by clusterbench /requestinfo',
+                    action='store_true')
+parser.add_argument('--pipeline', metavar='depth', type=int, default=1,
+                    help='Send up to depth requests at once over a connection')
+parser.add_argument('--no-keep-alive',
+                    help='Open a new connection for every request',
+                    action='store_true')
+parser.add_argument('--interval', metavar='seconds', type=float, default=None,
+                    help='Print throughput, errors and latency every interval')
+parser.add_argument('--prometheus', metavar='port', type=int, default=None,
+                    help='With --interval, serve metrics in Prometheus text '
+                    'format on http://localhost:port/metrics')
+parser.add_argument('--json', metavar='file',
+                    help='Write results as JSON to file ("-" for stdout, '
+                    'the report then goes to stderr)')
+parser.add_argument('--workload', metavar='file',
+                    help='Replay the requests of a workload file (JSON lines '
+                    'or an access log) on the host of url instead of '
+                    'sending -N requests to it')
 parser.add_argument('--print-response',
                     help='Print server response', action='store_true')
 parser.add_argument('--print-request',
@@ -27,85 +74,909 @@ parser.add_argument('--print-session-cookie-expired',
                     help='Print server response', action='store_true')
 
 
-def handler(opts):
+class Stats:
+    """Counters of one client; merged into totals when the run is over"""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        # Responses with 5xx status
+        self.server_errors = 0
+        # Requests that got no response by what went wrong
+        self.failures = {}
+        self.connections = 0
+        # Connections open right now
+        self.active = 0
+        # Connections taken from the pool rather than opened; a pipeline
+        # of requests takes one
+        self.reused = 0
+        self.elapsed = 0.0
+        self.connect = Histogram()
+        self.ttfb = Histogram()
+        self.latency = Histogram()
+        # Session affinity, see SessionTracker
+        self.routes = {}
+        self.no_route = 0
+        self.sessions = 0
+        self.affinity_breaks = 0
+        self.broken_sessions = 0
+        self.migrations = 0
+        # Latencies since the last interval, see live_metrics
+        self.window = None
+        # (time, status, seconds, route) of every request of this client
+        # when recorded, status 0 for failed ones; merged totals keep one
+        # list per client in timelines. See failover
+        self.timeline = None
+        self.timelines = []
+
+    def record_latency(self, seconds):
+        self.latency.record_seconds(seconds)
+        if self.window is not None:
+            self.window.append(seconds)
+
+    def record_response(self, status, start, route):
+        """Account a response to a request sent (or due) at start"""
+        end = perf_counter()
+        if status >= 500:
+            self.server_errors += 1
+        self.record_latency(end - start)
+        if self.timeline is not None:
+            self.timeline.append((end, status, end - start, route))
+
+    def record_failures(self, count, start, excpt):
+        """Account count requests that got no response because of excpt"""
+        self.errors += count
+        reason = '{0}: {1}'.format(type(excpt).__name__, excpt)
+        self.failures[reason] = self.failures.get(reason, 0) + count
+        if self.timeline is not None:
+            end = perf_counter()
+            self.timeline.extend([(end, 0, end - start, None)] * count)
+
+    def merge(self, other):
+        self.requests += other.requests
+        self.errors += other.errors
+        self.server_errors += other.server_errors
+        for reason, count in other.failures.items():
+            self.failures[reason] = self.failures.get(reason, 0) + count
+        self.connections += other.connections
+        self.active += other.active
+        self.reused += other.reused
+        # Clients (and workers) run side by side
+        self.elapsed = max(self.elapsed, other.elapsed)
+        self.connect.merge(other.connect)
+        self.ttfb.merge(other.ttfb)
+        self.latency.merge(other.latency)
+        for route, count in other.routes.items():
+            self.routes[route] = self.routes.get(route, 0) + count
+        self.no_route += other.no_route
+        self.sessions += other.sessions
+        self.affinity_breaks += other.affinity_breaks
+        self.broken_sessions += other.broken_sessions
+        self.migrations += other.migrations
+        self.timelines.extend(other.timelines)
+        if other.timeline is not None:
+            self.timelines.append(other.timeline)
+
+    def throughput(self):
+        """Responses per second; failed requests don't count"""
+        return self.latency.count / self.elapsed if self.elapsed else 0.0
+
+    def report(self):
+        acquired = self.connections + self.reused
+        reused_pct = 100.0 * self.reused / acquired if acquired else 0
+        print('Requests: {0}, errors: {1}, server errors: {2}'
+              .format(self.requests, self.errors, self.server_errors))
+        for reason, count in sorted(self.failures.items(),
+                                    key=lambda item: -item[1]):
+            print('  {0}: {1}'.format(reason, count))
+        if self.elapsed:
+            print('Elapsed: {0:.3f}s, throughput: {1:.1f} resp/s'
+                  .format(self.elapsed, self.throughput()))
+        print('Connections opened: {0}, reused: {1} ({2:.1f}% of uses)'
+              .format(self.connections, self.reused, reused_pct))
+        print('Connect: ' + self.connect.format())
+        print('TTFB:    ' + self.ttfb.format())
+        print('Total:   ' + self.latency.format())
+        if self.sessions or self.routes:
+            print('Sessions: {0}, affinity breaks: {1} in {2} sessions, '
+                  'migrations: {3}'.format(self.sessions, self.affinity_breaks,
+                                           self.broken_sessions,
+                                           self.migrations))
+            answered = sum(self.routes.values())
+            for route, count in sorted(self.routes.items()):
+                print('  {0}: {1} ({2:.1f}%)'
+                      .format(route, count, 100.0 * count / answered))
+            if self.no_route:
+                print('  no JVM route: {0}'.format(self.no_route))
+
+    def to_dict(self):
+        results = {'requests': self.requests,
+                   'errors': self.errors,
+                   'server_errors': self.server_errors,
+                   'failures': self.failures,
+                   'connections': self.connections,
+                   'reused': self.reused,
+                   'elapsed': self.elapsed,
+                   'throughput': self.throughput(),
+                   'latency_us': {'connect': self.connect.summary(),
+                                  'ttfb': self.ttfb.summary(),
+                                  'total': self.latency.summary()}}
+        if self.sessions or self.routes:
+            results['affinity'] = {'sessions': self.sessions,
+                                   'breaks': self.affinity_breaks,
+                                   'broken_sessions': self.broken_sessions,
+                                   'migrations': self.migrations,
+                                   'routes': self.routes,
+                                   'no_route': self.no_route}
+        return results
+
+
+class ConnectionPool:
+    """Persistent connections of a single client
+
+    With keep_alive set, a connection is handed back to the pool after
+    a complete response unless the server asked to close it. Without it
+    every request gets its own connection, which is closed afterwards.
+    The client's requests run one after another, so all its connections
+    share one response parser (and its buffer).
+    """
+
+    def __init__(self, addr, stats, keep_alive=True, max_idle=1):
+        self.addr = addr
+        self.stats = stats
+        self.keep_alive = keep_alive
+        self.max_idle = max_idle
+        self.idle = []
+        self.parser = ResponseParser()
+
+    def acquire(self):
+        """Return (socket, reused)"""
+        if self.idle:
+            self.stats.reused += 1
+            return self.idle.pop(), True
+        s = socket()
+        start = perf_counter()
+        try:
+            s.connect(self.addr)
+        except OSError:
+            s.close()
+            raise
+        self.stats.connect.record_seconds(perf_counter() - start)
+        self.stats.connections += 1
+        self.stats.active += 1
+        self.parser.clear()
+        return s, False
+
+    def release(self, s, reusable):
+        if self.keep_alive and reusable and len(self.idle) < self.max_idle:
+            self.idle.append(s)
+        else:
+            self.discard(s)
+
+    def discard(self, s):
+        s.close()
+        self.stats.active -= 1
+
+    def close(self):
+        for s in self.idle:
+            self.discard(s)
+        self.idle = []
+
+
+class RouteScanner:
+    """on_body callback picking "JVM route: <route>" out of a body
+
+    Works on raw bytes and stops looking once the route is found. A
+    short tail of each piece is kept in case the marker straddles two.
+    """
+
+    MARKER = b'JVM route:'
+    MAX_LINE = 256
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.route = None
+        self.tail = b''
+
+    def __call__(self, data):
+        if self.route is not None:
+            return
+        data = self.tail + bytes(data)
+        idx = data.find(self.MARKER)
+        if idx == -1:
+            self.tail = data[-len(self.MARKER):]
+            return
+        eol = data.find(b'\n', idx)
+        if eol == -1:
+            self.tail = data[idx:idx + self.MAX_LINE]
+            return
+        self.route = data[idx + len(self.MARKER):eol].strip().decode('latin-1')
+
+
+class SessionTracker:
+    """Follows the backend serving one client's session
+
+    The backend answering when a session cookie is issued is the
+    session's home. Any response from another backend while the same
+    cookie is sent is an affinity break; a new session cookie coming from
+    another backend is a migration (e.g. after failover).
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.route = None
+        self.broken = False
+
+    def update(self, sc, sc_new, route):
+        """Account a response to a request sent with session cookie sc"""
+        stats = self.stats
+        if route is None:
+            stats.no_route += 1
+        else:
+            stats.routes[route] = stats.routes.get(route, 0) + 1
+
+        if sc_new and sc_new != sc:
+            stats.sessions += 1
+            if sc and route != self.route:
+                stats.migrations += 1
+            self.route = route
+            self.broken = False
+        elif sc and route is not None:
+            if self.route is None:
+                self.route = route
+            elif route != self.route:
+                stats.affinity_breaks += 1
+                if not self.broken:
+                    stats.broken_sessions += 1
+                    self.broken = True
+
+
+def body_consumer(body, scanner):
+    """on_body callback collecting the body and/or scanning it"""
+    if body is None:
+        return scanner
+    if scanner is None:
+        return lambda data: body.append(bytes(data))
+
+    def consume(data):
+        body.append(bytes(data))
+        scanner(data)
+    return consume
+
+
+def send_schedule(opts):
+    """Generator of the times a client is supposed to send requests at
+
+    Returns None unless a rate is set. The rate is spread over all clients;
+    each client starts at a random offset within its first interval so the
+    clients don't fire in lockstep.
+    """
+    rate = opts.get('rate', None)
+    if not rate:
+        return None
+    client_rate = rate / opts.get('cli_num', 1)
+    poisson = opts.get('poisson', False)
+
+    def schedule():
+        intended = perf_counter() + random() / client_rate
+        while True:
+            yield intended
+            if poisson:
+                intended += expovariate(client_rate)
+            else:
+                intended += 1 / client_rate
+
+    return schedule()
+
+
+def parse_url(opts):
     url = opts.get('url', None)
     if not url:
         print('Missing url')
-        return
+        return None
 
     # invalid url - let's assume it is http://
     if not match('(?:http|ftp|https)://', url):
         url = 'http://' + url
 
-    o = urlparse(url)
-
-    sc = None
-    sc_changed = None
-    for i in range(opts.get('req_num', 1)):
-        # Session cookie expiration
-        if sc and opts.get('sc_timeout', -1) != -1 and\
-           (datetime.now() - sc_changed).microseconds > opts.get('sc_timeout', -1):
-            sc = None
-            if opts.get('print-session-cookie-expired', False):
-                print('Session cookie expired')
-
-        s = send_req(server=o.hostname,
-                     port=o.port,
-                     path=o.path,
-                     sc=sc,
-                     print_request=opts.get('print-request', False))
-        sc_new = get_resp(s, opts.get('print-response', False))
-        if sc_new and sc_new != sc:
-            sc_changed = datetime.now()
-            sc = sc_new
+    return urlparse(url)
 
 
-def get_resp(s, print_response):
-    resp = s.recv(4096).decode()
-    if print_response:
-        print(resp)
-    headers = resp[:resp.find('\r\n\r\n')]
-    for line in headers.split('\r\n'):
-        if line.find(':') != -1:
-            tmp = line.split(':')
-            name, value = tmp[0], tmp[1]
-            if name.lower() == 'set-cookie':
-                if value.lower().find('expires=') == -1:
-                    return value
-    return None
+class RequestTemplate:
+    """Request bytes encoded once; only the Cookie header is patched in"""
 
+    def __init__(self, server, path, keep_alive):
+        self.head = 'GET {0} HTTP/1.1\r\nHost: {1}\r\n'\
+            .format(path, server).encode()
+        self.tail = b'\r\n' if keep_alive else b'Connection: close\r\n\r\n'
+        self.plain = self.head + self.tail
+        self.head_request = False
+        self.sc = None
+        self.with_cookie = None
 
-def send_req(server, port, path, sc, print_request):
-    addr = str(server), port
-    req = "GET {0} HTTP/1.1\r\nHost: {1}\r\n".format(path, server)
+    def get(self, sc):
+        if not sc:
+            return self.plain
+        if sc != self.sc:
+            self.sc = sc
+            self.with_cookie = b''.join([self.head, b'Cookie: ',
+                                         sc.encode('latin-1'), b'\r\n',
+                                         self.tail])
+        return self.with_cookie
 
-    if sc:
-        req = req + 'Cookie: {0}\r\n'.format(sc)
 
-    req = req + '\r\n'
+class Client:
+    """State of one client independent of the engine running it
 
-    if print_request:
-        print(req)   
+    Keeps the session cookie, the request template, the send schedule
+    and affinity tracking, and splits the client's requests into batches
+    (of one request unless pipelining). Replaying a workload, the
+    template is that of the batch's entry and batches are single
+    requests.
+    """
 
-    s = socket()
-    r = s.connect(addr)
-    req_len = s.send(req.encode())
-    return s
+    def __init__(self, opts, o, stats, workload=None):
+        self.opts = opts
+        self.stats = stats
+        self.keep_alive = opts.get('keep-alive', True)
+        self.server = o.hostname
+        self.template = RequestTemplate(o.hostname, o.path or '/',
+                                        self.keep_alive)
+        self.workload = workload
+        # Connection: close ends a pipeline after the first response
+        self.depth = opts.get('pipeline', 1) \
+            if self.keep_alive and workload is None else 1
+        self.schedule = send_schedule(opts)
+        self.scanner = RouteScanner() if opts.get('affinity', False) else None
+        self.tracker = SessionTracker(stats) if self.scanner else None
+        self.print_request = opts.get('print-request', False)
+        self.print_response = opts.get('print-response', False)
+        self.sc = None
+        self.sc_changed = None
+        self.answered = False
 
+    def batches(self):
+        """Yield (session cookie, number of requests, intended send time)
 
-def perform_requests(opts):
+        With a send schedule a batch is due when its first request is,
+        otherwise when a workload entry's think time is over.
+        """
+        left = self.opts.get('req_num', 1)
+        while self.workload is not None or left > 0:
+            # Session cookie expiration
+            if self.sc and cookie_expired(self.sc_changed,
+                                          self.opts.get('sc_timeout', -1)):
+                self.sc = None
+                self.answered = False
+                if self.opts.get('print-session-cookie-expired', False):
+                    print('Session cookie expired')
+
+            # Until a response possibly carrying a session cookie arrives
+            # only one request goes out; the rest of a pipeline would open
+            # sessions of their own
+            think = 0.0
+            if self.workload is not None:
+                entry = self.workload.next()
+                if entry is None:
+                    return
+                self.template = self.workload.request(entry, self.server,
+                                                      self.keep_alive)
+                think = entry.think
+                count = 1
+            else:
+                count = min(self.depth if self.answered else 1, left)
+                left -= count
+
+            intended = None
+            if self.schedule is not None:
+                intended = next(self.schedule)
+                for i in range(count - 1):
+                    next(self.schedule)
+            elif think:
+                intended = perf_counter() + think
+
+            self.stats.requests += count
+            yield self.sc, count, intended
+
+    def account(self, sc, results):
+        """Process (session cookie, route) of responses to a batch sent with sc"""
+        if results:
+            self.answered = True
+        for sc_new, route in results:
+            if self.tracker:
+                self.tracker.update(sc, sc_new, route)
+            if sc_new and sc_new != self.sc:
+                self.sc_changed = datetime.now()
+                self.sc = sc_new
+
+
+def cookie_expired(sc_changed, sc_timeout):
+    if sc_timeout == -1:
+        return False
+    elapsed = datetime.now() - sc_changed
+    return elapsed.total_seconds() * 1000000 > sc_timeout
+
+
+def handler(opts, stats=None, workload=None):
+    o = parse_url(opts)
+    if o is None:
+        return
+
+    if stats is None:
+        stats = Stats()
+    client = Client(opts, o, stats, workload)
+    pool = ConnectionPool((str(o.hostname), o.port or 80), stats,
+                          client.keep_alive)
+
+    try:
+        for sc, count, intended in client.batches():
+            if intended is not None:
+                delay = intended - perf_counter()
+                if delay > 0:
+                    sleep(delay)
+            client.account(sc, pooled_req(pool, client, sc, count, intended))
+    finally:
+        pool.close()
+
+
+def pooled_req(pool, client, sc, count=1, intended=None):
+    """Send count requests over a pooled connection and read the responses
+
+    The requests are written at once (pipelined) and the responses read
+    in order. Return (session cookie, route) of every response received;
+    requests that failed are counted as errors.
+
+    A connection taken from the pool may have been closed by the server
+    in the meantime; in that case the requests are retried over a fresh
+    connection. So are requests left over when the server closes the
+    connection in the middle of a pipeline.
+
+    Total latency counts from the intended send time when given, so a
+    request delayed by a slow predecessor is charged for the wait
+    (coordinated omission correction).
+    """
+    start = perf_counter() if intended is None else intended
+    stats = pool.stats
+    parser = pool.parser
+    scanner = client.scanner
+    req = client.template.get(sc)
+    parser.head_request = client.template.head_request
+    results = []
+    while len(results) < count:
+        pending = count - len(results)
+        s = None
+        done = 0
+        reusable = False
+        try:
+            s, reused = pool.acquire()
+            if client.print_request:
+                for i in range(pending):
+                    print(req.decode('latin-1'))
+            sent = perf_counter()
+            s.sendall(req * pending)
+            while done < pending:
+                body = [] if client.print_response else None
+                parser.on_body = body_consumer(body, scanner)
+                if scanner:
+                    scanner.reset()
+                sc_new, reusable, first_byte = get_resp(s, parser)
+                done += 1
+                stats.ttfb.record_seconds(first_byte - sent)
+                route = scanner.route if scanner else None
+                stats.record_response(parser.status, start, route)
+                results.append((sc_new, route))
+                if body is not None:
+                    print_resp(parser, body)
+                if not reusable:
+                    break
+        except (OSError, ParseError) as excpt:
+            # Nothing to retry when connecting failed
+            if s is not None:
+                pool.discard(s)
+                if done or (reused and isinstance(excpt, OSError)):
+                    continue
+            stats.record_failures(pending, start, excpt)
+            return results
+        pool.release(s, reusable)
+    return results
+
+
+def get_resp(s, parser):
+    """Read one response from s
+
+    Return (session cookie, whether the connection may be reused,
+    time the first byte of the response arrived).
+    """
+    done = parser.next_response()
+    while not done:
+        nbytes = s.recv_into(parser.writable())
+        if not nbytes:
+            if not parser.eof():
+                raise ConnectionError('Connection closed by server')
+            break
+        done = parser.received(nbytes)
+    return parser.sc, parser.keep_alive, parser.first_byte
+
+
+def print_resp(parser, body):
+    print(parser.head + '\r\n\r\n' + b''.join(body).decode('utf-8', 'replace'))
 
+
+# Upper bound on connections being set up at once by the asyncio engine,
+# so that thousands of clients don't overflow the listen backlog
+MAX_CONNECTING = 256
+# Initial receive buffer of an asyncio client
+ASYNC_BUFFER_SIZE = 4096
+
+
+class ClientProtocol(asyncio.BufferedProtocol):
+    """Receives straight into the buffer of a ResponseParser
+
+    Reading is paused once a response is complete, so a client never
+    buffers more than its parser holds.
+    """
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.transport = None
+        self.waiter = None
+        self.closed = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self.parser.writable()
+
+    def buffer_updated(self, nbytes):
+        try:
+            done = self.parser.received(nbytes)
+        except ParseError as excpt:
+            self._wake(excpt)
+            self.transport.close()
+            return
+        if done:
+            self.transport.pause_reading()
+            self._wake()
+
+    def eof_received(self):
+        if self.parser.eof():
+            self._wake()
+        else:
+            self._wake(ConnectionError('Connection closed by server'))
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self._wake(exc or ConnectionError('Connection closed by server'))
+
+    def _wake(self, exc=None):
+        if self.waiter is None or self.waiter.done():
+            return
+        if exc is None:
+            self.waiter.set_result(None)
+        else:
+            self.waiter.set_exception(exc)
+
+    async def response(self):
+        """Wait until the parser holds the whole current response"""
+        if self.parser.done:
+            return
+        if self.closed:
+            raise ConnectionError('Connection closed by server')
+        self.waiter = asyncio.get_running_loop().create_future()
+        self.transport.resume_reading()
+        try:
+            await self.waiter
+        finally:
+            self.waiter = None
+
+
+class AsyncConnectionPool:
+    """ConnectionPool counterpart for the asyncio engine"""
+
+    def __init__(self, addr, stats, connecting, keep_alive=True):
+        self.addr = addr
+        self.stats = stats
+        self.connecting = connecting
+        self.keep_alive = keep_alive
+        self.idle = None
+        self.parser = ResponseParser(ASYNC_BUFFER_SIZE)
+
+    async def acquire(self):
+        """Return ((transport, protocol), reused)"""
+        if self.idle is not None:
+            conn, self.idle = self.idle, None
+            if not conn[1].closed:
+                self.stats.reused += 1
+                return conn, True
+            self.discard(conn)
+        self.parser.clear()
+        async with self.connecting:
+            start = perf_counter()
+            conn = await asyncio.get_running_loop().create_connection(
+                lambda: ClientProtocol(self.parser), *self.addr)
+            self.stats.connect.record_seconds(perf_counter() - start)
+        self.stats.connections += 1
+        self.stats.active += 1
+        return conn, False
+
+    def release(self, conn, reusable):
+        if self.keep_alive and reusable and self.idle is None:
+            self.idle = conn
+        else:
+            self.discard(conn)
+
+    def discard(self, conn):
+        conn[0].close()
+        self.stats.active -= 1
+
+    def close(self):
+        if self.idle is not None:
+            self.discard(self.idle)
+            self.idle = None
+
+
+async def async_handler(opts, stats, connecting, workload=None):
+    """handler() running as an asyncio task"""
+    o = parse_url(opts)
+    if o is None:
+        return
+
+    client = Client(opts, o, stats, workload)
+    pool = AsyncConnectionPool((str(o.hostname), o.port or 80), stats,
+                               connecting, client.keep_alive)
+
+    try:
+        for sc, count, intended in client.batches():
+            if intended is not None:
+                delay = intended - perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            client.account(sc, await async_pooled_req(pool, client, sc, count,
+                                                      intended))
+    finally:
+        pool.close()
+
+
+async def async_pooled_req(pool, client, sc, count=1, intended=None):
+    """pooled_req() for the asyncio engine"""
+    start = perf_counter() if intended is None else intended
+    stats = pool.stats
+    parser = pool.parser
+    scanner = client.scanner
+    req = client.template.get(sc)
+    parser.head_request = client.template.head_request
+    results = []
+    while len(results) < count:
+        pending = count - len(results)
+        conn = None
+        done = 0
+        try:
+            conn, reused = await pool.acquire()
+            transport, protocol = conn
+            if client.print_request:
+                for i in range(pending):
+                    print(req.decode('latin-1'))
+            sent = perf_counter()
+            transport.write(req * pending)
+            while done < pending:
+                body = [] if client.print_response else None
+                parser.on_body = body_consumer(body, scanner)
+                if scanner:
+                    scanner.reset()
+                parser.next_response()
+                await protocol.response()
+                done += 1
+                stats.ttfb.record_seconds(parser.first_byte - sent)
+                route = scanner.route if scanner else None
+                stats.record_response(parser.status, start, route)
+                results.append((parser.sc, route))
+                if body is not None:
+                    print_resp(parser, body)
+                if not parser.keep_alive:
+                    break
+        except (OSError, ParseError) as excpt:
+            # Nothing to retry when connecting failed
+            if conn is not None:
+                pool.discard(conn)
+                if done or (reused and isinstance(excpt, OSError)):
+                    continue
+            stats.record_failures(pending, start, excpt)
+            return results
+        pool.release(conn, parser.keep_alive)
+    return results
+
+
+def start_reporter(opts, source):
+    """Start reporting interval metrics if asked for
+
+    Worker processes pass their intervals to the parent's queue, otherwise
+    they are printed (and exported for Prometheus).
+    """
+    if not opts.get('interval', None):
+        return None
+    queue = opts.get('interval-queue', None)
+    if queue is not None:
+        sink = queue.put
+    else:
+        exporter = None
+        if opts.get('prometheus', None):
+            exporter = PrometheusExporter(opts['prometheus'])
+        sink = Printer(exporter)
+    reporter = Reporter(source, opts['interval'], sink)
+    reporter.start()
+    return reporter
+
+
+def stop_reporter(reporter):
+    if reporter is None:
+        return
+    reporter.stop()
+    # Whatever happened since the last full interval
+    reporter.emit()
+    if isinstance(reporter.source, Collector):
+        for client_stats in reporter.source.stats:
+            client_stats.window = None
+    exporter = getattr(reporter.sink, 'exporter', None)
+    if exporter is not None:
+        exporter.close()
+
+
+def raise_nofile_limit(needed):
+    """Raise the soft limit of open files up to the hard one if needed"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        if hard != resource.RLIM_INFINITY:
+            needed = min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+
+
+def new_stats(opts):
+    """Stats of a client, recording a timeline if asked for"""
+    stats = Stats()
+    if opts.get('timeline', False):
+        stats.timeline = []
+    return stats
+
+
+def open_workload(opts):
+    """Workload the clients of this process share, if replaying one"""
+    if not opts.get('workload', None):
+        return None
+    return Workload(opts['workload'], opts.get('workload-shard', (0, 1)))
+
+
+async def perform_requests_async(opts):
+    cli_num = opts.get('cli_num', 1)
+    raise_nofile_limit(cli_num + 64)
+    connecting = asyncio.Semaphore(MAX_CONNECTING)
+
+    stats = [new_stats(opts) for i in range(cli_num)]
+    workload = open_workload(opts)
+    reporter = start_reporter(opts, Collector(stats))
+    try:
+        await asyncio.gather(*[async_handler(opts, client_stats, connecting,
+                                             workload)
+                               for client_stats in stats])
+    finally:
+        stop_reporter(reporter)
+    if workload is not None and workload.error is not None:
+        raise workload.error
+
+    total = Stats()
+    for client_stats in stats:
+        total.merge(client_stats)
+    return total
+
+
+def perform_requests_threads(opts):
     threads = []
+    stats = []
+    workload = open_workload(opts)
     for i in range(opts.get('cli_num', 1)):
-        t = Thread(target=handler, args=(opts,))
+        stats.append(new_stats(opts))
+        t = Thread(target=handler, args=(opts, stats[-1], workload))
         threads.append(t)
 
+    reporter = start_reporter(opts, Collector(stats))
+
     for t in threads:
         t.start()
 
     for t in threads:
         t.join()
 
+    stop_reporter(reporter)
+    if workload is not None and workload.error is not None:
+        raise workload.error
+
+    total = Stats()
+    for client_stats in stats:
+        total.merge(client_stats)
+    return total
+
+
+def pin_to_cpu(index):
+    """Pin the calling process to one of the CPUs it may run on"""
+    if not hasattr(os, 'sched_setaffinity'):
+        return
+    cpus = sorted(os.sched_getaffinity(0))
+    os.sched_setaffinity(0, {cpus[index % len(cpus)]})
+
+
+def worker(job):
+    index, opts = job
+    pin_to_cpu(index)
+    return perform_requests(opts)
+
+
+def drain_intervals(queue):
+    """Merge intervals workers have reported so far"""
+    interval = Interval()
+    while True:
+        try:
+            interval.merge(queue.get_nowait())
+        except Empty:
+            return interval
+
+
+def perform_requests_workers(opts):
+    """Spread clients over worker processes and merge their results"""
+    workers = opts['workers']
+    cli_num = opts.get('cli_num', 1)
+    jobs = []
+    for i in range(workers):
+        shard = cli_num // workers + (1 if i < cli_num % workers else 0)
+        if shard:
+            job_opts = {**opts, 'cli_num': shard, 'workers': 1}
+            if opts.get('rate', None):
+                # Each worker takes its share of the total rate
+                job_opts['rate'] = opts['rate'] * shard / cli_num
+            jobs.append((i, job_opts))
+    # Every worker replays its share of a workload
+    for i, job_opts in jobs:
+        job_opts['workload-shard'] = (i, len(jobs))
+
+    with Manager() as manager, Pool(len(jobs)) as pool:
+        reporter = None
+        if opts.get('interval', None):
+            queue = manager.Queue()
+            for job in jobs:
+                job[1]['interval-queue'] = queue
+            reporter = start_reporter(opts, lambda: drain_intervals(queue))
+        try:
+            results = pool.map(worker, jobs, chunksize=1)
+        finally:
+            stop_reporter(reporter)
+
+    total = Stats()
+    for worker_stats in results:
+        total.merge(worker_stats)
+    return total
+
+
+def perform_requests(opts):
+    if opts.get('workers', 1) > 1:
+        return perform_requests_workers(opts)
+
+    start = monotonic()
+    if opts.get('engine', 'threads') == 'asyncio':
+        total = asyncio.run(perform_requests_async(opts))
+    else:
+        total = perform_requests_threads(opts)
+    total.elapsed = monotonic() - start
+    return total
+
+
+def report_json(results, file_name):
+    if file_name == '-':
+        print(json.dumps(results, indent=2))
+    else:
+        with open(file_name, 'w') as fdesc:
+            json.dump(results, fdesc, indent=2)
+
 
 if __name__ == "__main__":
 
@@ -119,10 +990,34 @@ if __name__ == "__main__":
             'req_num': args.N,
             'url': args.URL,
             'sc_timeout': args.timeout,
+            'rate': args.rate,
+            'poisson': args.poisson,
+            'engine': args.engine,
+            'pipeline': args.pipeline,
+            'interval': args.interval,
+            'prometheus': args.prometheus,
+            'affinity': args.affinity,
+            'workers': args.workers,
+            'workload': args.workload,
+            'keep-alive': not args.no_keep_alive,
             'print-request': args.print_request,
             'print-response': args.print_response,
             'print-session-cookie-expired': args.print_session_cookie_expired}
-    
-    perform_requests(opts)
 
-        
+    # With JSON on stdout everything else goes to stderr
+    with redirect_stdout(stderr if args.json == '-' else stdout):
+        if args.workload:
+            try:
+                check_workload(args.workload)
+            except (OSError, WorkloadError) as excpt:
+                print('Invalid workload: {0}'.format(excpt))
+                exit(1)
+        try:
+            stats = perform_requests(opts)
+        except WorkloadError as excpt:
+            # An invalid entry further on in the file
+            print('Invalid workload: {0}'.format(excpt))
+            exit(1)
+        stats.report()
+    if args.json:
+        report_json(stats.to_dict(), args.json)
@@ -0,0 +1,135 @@
+"""Concurrent service startup with readiness probes
+
+Every service is started in its own thread and then probed until ready:
+its probes must pass one after another (e.g. the port is open, the node
+is registered in the proxy, the application answers 200). Failing probes
+are retried after exponentially growing waits, so a service is noticed
+ready shortly after it is, not on the next whole second.
+"""
+
+import socket
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
+from threading import Event
+from time import monotonic
+from urllib.request import build_opener
+
+
+class StartupError(Exception):
+    pass
+
+
+class TcpProbe:
+    """Something accepts connections on host:port"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    def __str__(self):
+        return 'tcp {0}:{1}'.format(self.host, self.port)
+
+    def __call__(self, timeout):
+        socket.create_connection((self.host, self.port), timeout=timeout)\
+              .close()
+
+
+class HttpProbe:
+    """url answers status, with text in the body if given"""
+
+    def __init__(self, url, status=200, text=None, name=None):
+        self.url = url
+        self.status = status
+        self.text = text
+        self.name = name
+        # Without cookies, probing doesn't open sessions for the caller
+        self.opener = build_opener()
+
+    def __str__(self):
+        return self.name or 'http {0}'.format(self.url)
+
+    def __call__(self, timeout):
+        with self.opener.open(self.url, timeout=timeout) as resp:
+            if resp.status != self.status:
+                raise StartupError('{0} answered {1}'.format(self.url,
+                                                             resp.status))
+            if self.text is not None \
+                    and self.text.encode() not in resp.read():
+                raise StartupError('{0} not in {1}'.format(self.text,
+                                                           self.url))
+
+
+class Service:
+    """A service started by calling start, ready when probes pass"""
+
+    def __init__(self, name, start, probes):
+        self.name = name
+        self.start = start
+        self.probes = probes
+
+
+class Orchestrator:
+    """Starts services concurrently and waits until all are ready
+
+    start_all() returns {service name: [(step, seconds since start)]}
+    with a step for the start itself and for every probe passed. The
+    first service that fails to come up stops waiting for the others.
+    """
+
+    def __init__(self, services, timeout=120.0, initial_wait=0.05,
+                 max_wait=1.0):
+        self.services = services
+        self.timeout = timeout
+        self.initial_wait = initial_wait
+        self.max_wait = max_wait
+        self.stopped = Event()
+
+    def wait_for(self, service, probe, deadline):
+        pause = self.initial_wait
+        while not self.stopped.is_set():
+            try:
+                probe(timeout=max(self.max_wait, 1.0))
+                return
+            except (OSError, StartupError) as excpt:
+                # URLError and HTTPError are OSErrors too
+                if monotonic() + pause > deadline:
+                    raise StartupError('{0} not ready, {1}: {2}'
+                                       .format(service.name, probe, excpt))
+            self.stopped.wait(pause)
+            pause = min(pause * 2, self.max_wait)
+        raise StartupError('{0}: startup given up'.format(service.name))
+
+    def bring_up(self, service, began):
+        steps = []
+        service.start()
+        steps.append(('started', monotonic() - began))
+        deadline = began + self.timeout
+        for probe in service.probes:
+            self.wait_for(service, probe, deadline)
+            steps.append((str(probe), monotonic() - began))
+        print('{0} ready in {1:.2f}s'.format(service.name, steps[-1][1]))
+        return steps
+
+    def start_all(self):
+        began = monotonic()
+        self.stopped.clear()
+        with ThreadPoolExecutor(max_workers=len(self.services)) as executor:
+            futures = [(service, executor.submit(self.bring_up, service,
+                                                 began))
+                       for service in self.services]
+            done, _ = wait([future for _, future in futures],
+                           return_when=FIRST_EXCEPTION)
+            for future in done:
+                if future.exception() is not None:
+                    self.stopped.set()
+                    raise future.exception()
+            return {service.name: future.result()
+                    for service, future in futures}
+
+
+def print_report(report):
+    """Print time to ready of services per start_all()"""
+    for name, steps in report.items():
+        print('{0:<12} ready {1:>7.2f}s  {2}'.format(
+            name, steps[-1][1],
+            ', '.join('{0} {1:.2f}s'.format(step, seconds)
+                      for step, seconds in steps)))
@@ -0,0 +1,107 @@
+"""N Tomcat instances sharing one pristine Tomcat
+
+Each node is a CATALINA_BASE of its own next to the shared
+CATALINA_HOME: bin and lib (where mod_cluster lives) are used straight
+from the pristine tree, webapps are hard-linked (reflinked or copied
+where links can't be made), only conf is a real copy, with the node's
+ports and jvmRoute in server.xml rendered from the pristine one. Node i
+(from 0) listens on the default ports plus PORT_STEP * i.
+"""
+
+from os import kill, makedirs
+from os.path import exists, join
+from random import sample
+from shutil import rmtree
+from signal import SIGKILL
+import configs
+from tracing import tracer
+
+SHUTDOWN_PORT = 8005
+HTTP_PORT = 8080
+AJP_PORT = 8009
+PORT_STEP = 100
+
+
+def link_tree(src, dst):
+    """Make dst a copy of src sharing file data where possible"""
+    if tracer.call(['cp', '-al', src, dst]) == 0:
+        return
+    if exists(dst):
+        rmtree(dst)
+    if tracer.call(['cp', '-a', '--reflink=auto', src, dst]) != 0:
+        raise OSError('Copying {0} to {1} failed'.format(src, dst))
+
+
+class TomcatNode:
+    """One Tomcat instance of a Topology"""
+
+    def __init__(self, index, home, base):
+        self.index = index
+        self.route = 'tomcat{0}'.format(index + 1)
+        self.home = home
+        self.base = base
+        self.shutdown_port = SHUTDOWN_PORT + PORT_STEP * index
+        self.http_port = HTTP_PORT + PORT_STEP * index
+        self.ajp_port = AJP_PORT + PORT_STEP * index
+        self.pid_path = join(base, 'pids', 'pid')
+
+    def catalina(self):
+        return join(self.home, 'bin', 'catalina.sh')
+
+    def env(self, environ):
+        return {**dict(environ), 'CATALINA_HOME': self.home,
+                'CATALINA_BASE': self.base, 'CATALINA_PID': self.pid_path}
+
+    def build(self, address):
+        if exists(self.base):
+            rmtree(self.base)
+        makedirs(self.base)
+        tracer.call(['cp', '-a', '--reflink=auto', join(self.home, 'conf'),
+                     join(self.base, 'conf')])
+        configs.render_file(join(self.home, 'conf', 'server.xml'),
+                            join(self.base, 'conf', 'server.xml'),
+                            configs.SERVER_XML, ip=address, route=self.route,
+                            shutdown_port=self.shutdown_port,
+                            http_port=self.http_port, ajp_port=self.ajp_port)
+        link_tree(join(self.home, 'webapps'), join(self.base, 'webapps'))
+        for name in ['logs', 'temp', 'work', 'pids']:
+            makedirs(join(self.base, name))
+        # catalina.sh wants the pid file to exist
+        open(self.pid_path, 'a').close()
+
+    def kill(self):
+        with open(self.pid_path) as fdesc:
+            kill(int(fdesc.read()), SIGKILL)
+
+
+class Topology:
+    """count nodes under root, all running the Tomcat in home and
+    listening on address"""
+
+    def __init__(self, home, root, count, address):
+        self.home = home
+        self.root = root
+        self.address = address
+        self.nodes = [TomcatNode(i, home, join(root, 'tomcat{0}'.format(i + 1)))
+                      for i in range(count)]
+
+    def build(self):
+        for node in self.nodes:
+            node.build(self.address)
+        return self.nodes
+
+    def node(self, route):
+        for node in self.nodes:
+            if node.route == route:
+                return node
+        raise KeyError('No node {0}'.format(route))
+
+    def kill_random(self, count=None):
+        """Kill count random nodes, half of them by default; one survives"""
+        if count is None:
+            count = max(1, len(self.nodes) // 2)
+        victims = sample(self.nodes, min(count, len(self.nodes) - 1))
+        for node in victims:
+            print('Killing {0}'.format(node.route))
+            node.kill()
+        return victims
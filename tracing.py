@@ -0,0 +1,141 @@
+"""Timed spans of a hw.py run, exported as a Chrome trace
+
+Phases are spans opened with Tracer.span(); commands run through
+Tracer.call() become spans of their own carrying the CPU time and peak
+RSS of the child process (from wait4(), so it's exact even when several
+commands run at once). Downloads are spans of their own too and count
+among the commands in the summary. Phases get the CPU time of all children reaped
+while they were open and the largest RSS of commands run within them.
+
+The trace loads into chrome://tracing or https://ui.perfetto.dev.
+"""
+
+import json
+import threading
+from contextlib import contextmanager
+from os import getpid, wait4, waitstatus_to_exitcode
+from os.path import basename
+from resource import getrusage, RUSAGE_CHILDREN
+from subprocess import Popen
+from time import monotonic
+
+
+class Span:
+    """One timed step"""
+
+    def __init__(self, name, cat, args=None):
+        self.name = name
+        self.cat = cat
+        self.args = args or {}
+        self.tid = threading.get_ident()
+        self.start = monotonic()
+        self.end = None
+
+    def duration(self):
+        return (self.end if self.end is not None else monotonic()) \
+            - self.start
+
+    def event(self, origin, pid):
+        return {'name': self.name, 'cat': self.cat, 'ph': 'X',
+                'ts': int((self.start - origin) * 1000000),
+                'dur': int(self.duration() * 1000000),
+                'pid': pid, 'tid': self.tid, 'args': self.args}
+
+
+class Tracer:
+    """Collects spans from any thread"""
+
+    def __init__(self):
+        self.origin = monotonic()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    @contextmanager
+    def span(self, name, cat='phase', **args):
+        span = Span(name, cat, args)
+        usage = getrusage(RUSAGE_CHILDREN)
+        try:
+            yield span
+        finally:
+            span.end = monotonic()
+            after = getrusage(RUSAGE_CHILDREN)
+            span.args['child_cpu_s'] = round(
+                after.ru_utime - usage.ru_utime
+                + after.ru_stime - usage.ru_stime, 3)
+            with self.lock:
+                rss = [inner.args.get('max_rss_kb', 0) for inner in self.spans
+                       if inner.cat == 'cmd' and inner.start >= span.start
+                       and inner.end <= span.end]
+            span.args['max_rss_kb'] = max(rss, default=0)
+            self.add(span)
+
+    def call(self, argv, **kwargs):
+        """subprocess.call() recording a span with child CPU and RSS"""
+        span = Span(basename(argv[0]), 'cmd', {'argv': ' '.join(argv)})
+        proc = Popen(argv, **kwargs)
+        try:
+            _, status, usage = wait4(proc.pid, 0)
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+        proc.returncode = waitstatus_to_exitcode(status)
+        span.end = monotonic()
+        span.args.update({'returncode': proc.returncode,
+                          'user_s': round(usage.ru_utime, 3),
+                          'sys_s': round(usage.ru_stime, 3),
+                          'max_rss_kb': usage.ru_maxrss})
+        self.add(span)
+        return proc.returncode
+
+    def export(self, file_name):
+        """Write spans as Chrome trace-event JSON"""
+        pid = getpid()
+        with self.lock:
+            spans = list(self.spans)
+        events = [span.event(self.origin, pid) for span in spans]
+        for thread in threading.enumerate():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                           'tid': thread.ident,
+                           'args': {'name': thread.name}})
+        with open(file_name, 'w') as fdesc:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'},
+                      fdesc)
+
+    def summary(self, top=10):
+        """Return phases in order and the commands taking longest"""
+        with self.lock:
+            spans = list(self.spans)
+        lines = ['{0:<32} {1:>9} {2:>9} {3:>10}'.format(
+            'phase', 'wall s', 'cpu s', 'max rss MB')]
+        for span in sorted((span for span in spans if span.cat == 'phase'),
+                           key=lambda span: span.start):
+            lines.append('{0:<32} {1:>9.1f} {2:>9.1f} {3:>10.1f}'.format(
+                span.name, span.duration(), span.args['child_cpu_s'],
+                span.args['max_rss_kb'] / 1024))
+
+        totals = {}
+        for span in spans:
+            if span.cat not in ('cmd', 'download'):
+                continue
+            count, wall, cpu, rss = totals.get(span.name, (0, 0.0, 0.0, 0))
+            totals[span.name] = (count + 1, wall + span.duration(),
+                                 cpu + span.args.get('user_s', 0.0)
+                                 + span.args.get('sys_s', 0.0),
+                                 max(rss, span.args['max_rss_kb']))
+        lines.append('')
+        lines.append('{0:<24} {1:>7} {2:>9} {3:>9} {4:>10}'.format(
+            'command', 'calls', 'wall s', 'cpu s', 'max rss MB'))
+        for name, (count, wall, cpu, rss) in sorted(
+                totals.items(), key=lambda item: -item[1][1])[:top]:
+            lines.append('{0:<24} {1:>7} {2:>9.1f} {3:>9.1f} {4:>10.1f}'
+                         .format(name, count, wall, cpu, rss / 1024))
+        return '\n'.join(lines)
+
+
+# The tracer of this process
+tracer = Tracer()
@@ -0,0 +1,158 @@
+"""Recorded workloads for req_send.py to replay
+
+A workload file has one request per line, either a JSON object
+
+    {"method": "POST", "path": "/clusterbench/session",
+     "headers": {"Content-Type": "text/plain"}, "body": "...",
+     "think_ms": 50}
+
+(only path is required; think_ms is how long a client waits before
+sending it) or an access log line in common or combined format, of
+which the "%r" request line is used. Empty lines and lines starting with
+# are skipped.
+
+Files are read a line at a time as clients ask for the next request,
+never as a whole. Each distinct entry is encoded into request bytes once
+(the most recent ones are kept), so the clients only splice in their
+session cookie.
+"""
+
+import json
+from collections import namedtuple
+from functools import lru_cache
+from threading import Lock
+
+# Compiled requests kept around
+CACHE_SIZE = 64 * 1024
+
+Entry = namedtuple('Entry', ['method', 'path', 'headers', 'body', 'think'])
+
+
+class WorkloadError(ValueError):
+    pass
+
+
+def parse_json(line):
+    try:
+        data = json.loads(line)
+        headers = tuple(sorted(data.get('headers', {}).items()))
+        think = data.get('think_ms', 0)
+        # Entries are hashed and encoded later, away from the file
+        if not all(isinstance(value, str)
+                   for header in headers for value in header):
+            raise TypeError('headers have to map strings to strings')
+        if isinstance(think, bool) or not isinstance(think, (int, float)):
+            raise TypeError('think_ms has to be a number')
+        entry = Entry(data.get('method', 'GET').upper(), data['path'],
+                      headers, data.get('body', '').encode('utf-8'),
+                      think / 1000)
+        # Request heads are latin-1
+        ' '.join([entry.method, entry.path]
+                 + [value for header in headers
+                    for value in header]).encode('latin-1')
+        return entry
+    except (ValueError, KeyError, AttributeError, TypeError) as excpt:
+        raise WorkloadError('Invalid entry {0!r}: {1}'.format(line, excpt))
+
+
+def parse_access_log(line):
+    """Entry of the request line of an access log line or None"""
+    start = line.find('"')
+    end = line.find('"', start + 1)
+    if start < 0 or end < 0:
+        return None
+    request = line[start + 1:end].split(' ')
+    if len(request) != 3 or not request[1].startswith('/'):
+        # "-" of requests that never got a request line out
+        return None
+    return Entry(request[0], request[1], (), b'', 0.0)
+
+
+def read_entries(path):
+    """Yield the Entries of workload file path"""
+    with open(path, encoding='utf-8', errors='replace') as fdesc:
+        for number, line in enumerate(fdesc, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('{'):
+                try:
+                    yield parse_json(line)
+                except WorkloadError as excpt:
+                    raise WorkloadError('{0}:{1}: {2}'.format(path, number,
+                                                              excpt))
+            else:
+                entry = parse_access_log(line)
+                if entry is not None:
+                    yield entry
+
+
+def check(path):
+    """Raise OSError or WorkloadError unless path starts with a valid
+    entry"""
+    entries = read_entries(path)
+    try:
+        if next(entries, None) is None:
+            raise WorkloadError('No requests in {0}'.format(path))
+    finally:
+        entries.close()
+
+
+class Request:
+    """Bytes of one entry sent to server; only the Cookie header is patched
+    in (unless the entry has one of its own)"""
+
+    def __init__(self, entry, server, keep_alive):
+        lines = ['{0} {1} HTTP/1.1'.format(entry.method, entry.path),
+                 'Host: {0}'.format(server)]
+        lines += ['{0}: {1}'.format(name, value)
+                  for name, value in entry.headers]
+        if entry.body:
+            lines.append('Content-Length: {0}'.format(len(entry.body)))
+        self.head = ('\r\n'.join(lines) + '\r\n').encode('latin-1')
+        self.tail = (b'\r\n' if keep_alive else b'Connection: close\r\n\r\n') \
+            + entry.body
+        self.plain = self.head + self.tail
+        self.own_cookie = any(name.lower() == 'cookie'
+                              for name, value in entry.headers)
+        self.head_request = entry.method == 'HEAD'
+
+    def get(self, sc):
+        if not sc or self.own_cookie:
+            return self.plain
+        # Shared by all clients, so nothing is cached per cookie
+        return b''.join([self.head, b'Cookie: ', sc.encode('latin-1'),
+                         b'\r\n', self.tail])
+
+
+class Workload:
+    """Entries of a workload file handed out to the clients of a process
+
+    With shard (index, count) only every count-th entry starting with
+    the index-th one is used, so worker processes split a workload
+    instead of each replaying all of it. An invalid entry ends the
+    workload for all clients and is kept in error.
+    """
+
+    def __init__(self, path, shard=(0, 1)):
+        self.entries = read_entries(path)
+        self.index, self.count = shard
+        self.lock = Lock()
+        self.error = None
+        self.request = lru_cache(maxsize=CACHE_SIZE)(Request)
+
+    def next(self):
+        """The next entry or None when the workload is over"""
+        # Threads take turns on the one generator
+        with self.lock:
+            if self.error is not None:
+                return None
+            entry = None
+            try:
+                for i in range(self.index + 1):
+                    entry = next(self.entries, None)
+            except WorkloadError as excpt:
+                self.error = excpt
+                return None
+            self.index = self.count - 1
+            return entry